@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for collect_nodes.py: generates a synthetic lastz-style alignment table and
+times each stage (read_nodes, collect_nodes, collect_nodes_stream, filter_nodes,
+build_scaffolds) in a separate process, reporting rows/s and peak memory.
+Results can be saved as a baseline and compared against later runs.
+"""
+
+__author__ = "Harald Grove"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import collect_nodes
+
+# Stage that writes the input file of another stage
+NEEDS = {"filter_nodes": "collect_nodes", "build_scaffolds": "filter_nodes"}
+
+# Settings that do not change the measurements, ignored when comparing with a baseline
+UNCOMPARED = ("stages", "repeat", "tolerance")
+
+HEADER = (
+    "#score\tname1\tstrand1\tsize1\tzstart1\tend1\tname2\tstrand2\tsize2\tzstart2\tend2"
+    "\tidentity\tidPct\tcoverage\tcovPct\n"
+)
+
+
+def generate(args, outfile):
+    """
+    Writes a synthetic alignment table. Contigs of assembly 1 and 2 are split into
+    clusters with a mean of --block-size contigs, and alignments are drawn within a
+    cluster, with Zipf-distributed (--alpha) choice of contigs, so a few contigs in each
+    cluster get most of the hits. A fraction (--hub-rate) of the alignments go to one
+    of --hubs global hub contigs, joining clusters into larger components.
+    :param args:
+    :param outfile: Name of output file
+    :return: Number of rows
+    """
+    rng = random.Random(args.seed)
+    clusters = []
+    n1 = n2 = 0
+    while n1 < args.contigs:
+        size = max(2, int(rng.expovariate(1 / args.block_size)))
+        clusters.append((n1, min(size, args.contigs - n1), n2, max(1, size // 2)))
+        n1 += size
+        n2 += max(1, size // 2)
+    weights = [c[1] for c in clusters]
+    zipf = {}
+
+    def pick(offset, size):
+        if size not in zipf:
+            zipf[size] = [1 / (i + 1) ** args.alpha for i in range(size)]
+        return offset + rng.choices(range(size), weights=zipf[size])[0]
+
+    sizes1 = [rng.randint(5000, 200000) for i in range(n1)]
+    sizes2 = [rng.randint(5000, 2000000) for i in range(n2 + args.hubs)]
+    with open(outfile, "w") as fout:
+        fout.write(HEADER)
+        for row in range(args.rows):
+            off1, size1, off2, size2 = rng.choices(clusters, weights=weights)[0]
+            a = pick(off1, size1)
+            if args.hubs > 0 and rng.random() < args.hub_rate:
+                b = n2 + rng.randrange(args.hubs)
+            else:
+                b = pick(off2, size2)
+            length = rng.randint(100, 5000)
+            zstart1 = rng.randint(0, max(0, sizes1[a] - length))
+            zstart2 = rng.randint(0, max(0, sizes2[b] - length))
+            ident = rng.randint(int(length * 0.95), length)
+            cov = rng.randint(length // 2, length)
+            fout.write(
+                "{}\tctg{}\t+\t{}\t{}\t{}\tscf{}\t{}\t{}\t{}\t{}\t{}/{}\t{:.1f}%\t{}/{}\t{:.1f}%\n".format(
+                    rng.randint(1000, 500000),
+                    a,
+                    sizes1[a],
+                    zstart1,
+                    zstart1 + length,
+                    b,
+                    rng.choice("+-"),
+                    sizes2[b],
+                    zstart2,
+                    zstart2 + length,
+                    ident,
+                    length,
+                    100 * ident / length,
+                    length,
+                    cov + length,
+                    100 * length / (cov + length),
+                )
+            )
+    return args.rows
+
+
+def count_rows(filename):
+    with open(filename, "r") as fin:
+        return sum(1 for line in fin if not line.startswith("#"))
+
+
+def stage_args(args, infile, output, **kw):
+    """
+    Arguments for collect_nodes, as given on the command line
+    """
+    options = dict(
+        infile=infile,
+        output=output,
+        columns="2,7",
+        verbose=0,
+        filter=False,
+        build=False,
+        stream=False,
+        update=False,
+        state=None,
+        fused=False,
+        chunksize=args.chunksize,
+        jobs=args.jobs,
+        min_identity=0.98,
+        min_length=500,
+        min_coverage=0.8,
+    )
+    options.update(kw)
+    return argparse.Namespace(**options)
+
+
+def run_stage(name, options):
+    """
+    Runs one stage, called in a new process so peak memory is measured per stage
+    :return: (seconds, peak RSS in MB)
+    """
+    t = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if name == "read_nodes":
+            collect_nodes.read_nodes(options)
+        elif name == "collect_nodes":
+            names, pairs, data = collect_nodes.read_nodes(options)
+            collect_nodes.collect_nodes(options, names, pairs, data)
+        elif name == "collect_nodes_stream":
+            collect_nodes.collect_nodes_stream(options)
+        elif name == "filter_nodes":
+            collect_nodes.filter_nodes(options)
+        elif name == "build_scaffolds":
+            collect_nodes.build_scaffolds(options)
+    elapsed = time.perf_counter() - t
+    # Worker processes of a parallel stage are counted as children
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return elapsed, peak / 1024
+
+
+def _stage_process(name, options, conn):
+    conn.send(run_stage(name, options))
+    conn.close()
+
+
+def measure(ctx, name, options):
+    """
+    Runs one stage in a new process, which is not daemonic so the stage can start its
+    own pool of workers (--jobs)
+    :return: (seconds, peak RSS in MB)
+    """
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_stage_process, args=(name, options, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError("Stage {} failed".format(name))
+    return result
+
+
+def benchmark(args, workdir):
+    """
+    Generates the input and runs all stages
+    :return: {stage: {"rows": ..., "seconds": ..., "rows_per_s": ..., "peak_mb": ...}}
+    """
+    table = os.path.join(workdir, "aln.txt")
+    grouped = os.path.join(workdir, "grouped.txt")
+    t = time.perf_counter()
+    rows = generate(args, table)
+    print("Generated {} rows in {:.1f}s".format(rows, time.perf_counter() - t))
+    stages = [
+        ("read_nodes", table, stage_args(args, table, grouped)),
+        ("collect_nodes", table, stage_args(args, table, grouped)),
+        (
+            "collect_nodes_stream",
+            table,
+            stage_args(args, table, os.path.join(workdir, "stream.txt"), stream=True),
+        ),
+        ("filter_nodes", grouped, stage_args(args, grouped, grouped, filter=True)),
+        (
+            "build_scaffolds",
+            os.path.join(workdir, "grouped.A.txt"),
+            stage_args(
+                args,
+                os.path.join(workdir, "grouped.A.txt"),
+                os.path.join(workdir, "scaffolds.txt"),
+                build=True,
+            ),
+        ),
+    ]
+    selected = [
+        s[0] for s in stages if not args.stages or s[0] in args.stages.split(",")
+    ]
+    # Stages that are not selected, but write the input of a selected stage
+    setup = set()
+    for name in selected:
+        while name in NEEDS and NEEDS[name] not in selected:
+            name = NEEDS[name]
+            setup.add(name)
+    ctx = multiprocessing.get_context("spawn")
+    for name, infile, options in stages:
+        if name in setup:
+            print("Preparing input with {} (not timed)".format(name))
+            measure(ctx, name, options)
+    results = {}
+    for name, infile, options in stages:
+        if name not in selected:
+            continue
+        n = count_rows(infile)
+        times, peak = [], 0
+        for repeat in range(args.repeat):
+            seconds, mb = measure(ctx, name, options)
+            times.append(seconds)
+            peak = max(peak, mb)
+        best = min(times)
+        results[name] = {
+            "rows": n,
+            "seconds": best,
+            "rows_per_s": n / best if best > 0 else 0,
+            "peak_mb": peak,
+        }
+    return results
+
+
+def report(results, baseline=None, tolerance=0.1):
+    """
+    Prints the results, and the change relative to a baseline
+    :return: True if no stage is slower or uses more memory than the tolerance allows
+    """
+    ok = True
+    print(
+        "{:<22}{:>10}{:>10}{:>14}{:>10}".format("stage", "rows", "seconds", "rows/s", "peak MB")
+    )
+    for name, r in results.items():
+        line = "{:<22}{:>10}{:>10.2f}{:>14.0f}{:>10.1f}".format(
+            name, r["rows"], r["seconds"], r["rows_per_s"], r["peak_mb"]
+        )
+        if baseline and name in baseline:
+            b = baseline[name]
+            speed = r["rows_per_s"] / b["rows_per_s"] if b["rows_per_s"] else 0
+            memory = r["peak_mb"] / b["peak_mb"] if b["peak_mb"] else 0
+            flag = ""
+            if speed < 1 - tolerance or memory > 1 + tolerance:
+                flag = "  REGRESSION"
+                ok = False
+            line += "   speed x{:.2f}, memory x{:.2f}{}".format(speed, memory, flag)
+        print(line)
+    return ok
+
+
+def main(args):
+    """ Main entry point of the app """
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = benchmark(args, workdir)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as fin:
+            saved = json.load(fin)
+        baseline = saved["results"]
+        current = vars(args)
+        for key, value in saved.get("settings", {}).items():
+            if key in UNCOMPARED or current.get(key) == value:
+                continue
+            sys.stderr.write(
+                "Warning: baseline was run with {}={}, this run has {}\n".format(
+                    key, value, current.get(key)
+                )
+            )
+    ok = report(results, baseline, args.tolerance)
+    if args.save:
+        settings = {
+            k: v for k, v in vars(args).items() if k not in ("save", "compare", "workdir")
+        }
+        with open(args.save, "w") as fout:
+            json.dump({"settings": settings, "results": results}, fout, indent=2)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Optional argument which requires a parameter (eg. -d test)
+    parser.add_argument("-r", "--rows", type=int, default=200000, help="Alignment rows")
+    parser.add_argument(
+        "-n", "--contigs", type=int, default=20000, help="Contigs in assembly 1"
+    )
+    parser.add_argument(
+        "-b", "--block-size", type=float, default=20, help="Mean contigs per cluster"
+    )
+    parser.add_argument(
+        "-a", "--alpha", type=float, default=1.2, help="Zipf exponent for contig choice"
+    )
+    parser.add_argument("--hubs", type=int, default=5, help="Number of hub contigs")
+    parser.add_argument(
+        "--hub-rate", type=float, default=0.001, help="Fraction of rows hitting a hub"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument(
+        "--stages", help="Comma-separated stages to run (default: all)"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per stage, best is kept")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="See collect_nodes.py")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="See collect_nodes.py")
+    parser.add_argument("--workdir", help="Directory for temporary files")
+    parser.add_argument("-s", "--save", help="Save results as a baseline (JSON)")
+    parser.add_argument("-c", "--compare", help="Compare with a saved baseline")
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed slowdown / memory growth before reporting a regression",
+    )
+
+    # Specify output of '--version'
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__),
+    )
+
+    args = parser.parse_args()
+    main(args)
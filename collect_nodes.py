@@ -10,67 +10,415 @@ __license__ = "MIT"
 import argparse
 import time
 import sys
-import random
+import os
+import heapq
+import io
+import pickle
+import tempfile
+import multiprocessing
+from collections import deque
+from array import array
+import numpy as np
 import pandas as pd
 
 
-def read_nodes(args):
-    data = {}
-    tree = {}
-    most = 0
-    c1, c2 = args.columns.split(",")
-    with open(args.infile, "r") as fin:
+def iter_alignments(infile, columns):
+    """
+    Reads the alignment lines, skipping comments and lines without the node columns
+    :param infile: Alignment file
+    :param columns: Columns with nodes, 1-based, e.g. "1,2"
+    :return: Generator of (split line, name1, name2)
+    """
+    c1, c2 = [int(c) - 1 for c in columns.split(",")]
+    with open(infile, "r") as fin:
         for line in fin:
             if line.startswith("#"):
                 continue
             l = line.strip().split()
             try:
-                name1, name2 = l[int(c1) - 1], l[int(c2) - 1]
+                name1, name2 = l[c1], l[c2]
             except IndexError:
                 continue
-            key = tuple(sorted([name1, name2]))
-            if key not in data:
-                data[key] = []
-            data[key].append(l)
-            if name1 not in tree:
-                tree[name1] = []
-            if name2 not in tree:
-                tree[name2] = []
-            if name2 not in tree[name1]:
-                tree[name1].append(name2)
-                most = max(len(tree[name1]), most)
-            if name1 not in tree[name2]:
-                tree[name2].append(name1)
-                most = max(len(tree[name2]), most)
-    print("Most connections: {}".format(most))
-    return tree, data
-
-
-def go_wide(tree, node1, data, fout):
-    if node1 not in tree:
-        return
-    nodes = tree.pop(node1)
-    for node2 in nodes:
-        key = tuple(sorted([node1, node2]))
-        if key not in data:
-            continue
-        lines = data.pop(key)
-        for line in lines:
-            fout.write("{}\n".format("\t".join(line)))
-        go_wide(tree, node2, data, fout)
+            yield l, name1, name2
+
+
+def read_nodes(args):
+    """
+    Reads the alignments into a graph, with the sequences as nodes and an edge between
+    every pair of sequences that have alignments between them.
+    Sequence names are stored once, as integer node ids, and each pair of nodes gets an
+    integer edge id, in order of first appearance.
+    :param args:
+    :return: names (list, name of each node id), pairs (flat array with the two node ids
+             of each edge) and data (list, the lines of each edge id)
+    """
+    ids = {}
+    edges = {}
+    pairs = array("q")
+    degree = array("q")
+    data = []
+    for l, name1, name2 in iter_alignments(args.infile, args.columns):
+        node1 = ids.setdefault(name1, len(ids))
+        node2 = ids.setdefault(name2, len(ids))
+        while len(degree) < len(ids):
+            degree.append(0)
+        key = (min(node1, node2) << 32) | max(node1, node2)
+        edge = edges.get(key)
+        if edge is None:
+            edge = edges[key] = len(data)
+            data.append([])
+            pairs.append(node1)
+            pairs.append(node2)
+            degree[node1] += 1
+            if node1 != node2:
+                degree[node2] += 1
+        data[edge].append("\t".join(l))
+    print("Most connections: {}".format(max(degree, default=0)))
+    return list(ids), pairs, data
+
+
+def find_root(parent, node):
+    """
+    Finds the root of a node in a union-find forest, halving the path on the way
+    :param parent: Array with the parent of each node
+    :param node: Node id
+    :return: Root node id
+    """
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+
+def union(parent, node1, node2):
+    """
+    Joins the sets of two nodes, the smallest root becomes the root of both
+    :param parent: Array with the parent of each node
+    :return: None
+    """
+    root1, root2 = find_root(parent, node1), find_root(parent, node2)
+    if root1 < root2:
+        parent[root2] = root1
+    elif root2 < root1:
+        parent[root1] = root2
+
+
+def find_components(n, pairs):
+    """
+    Finds the connected components of the graph with union-find, without recursion
+    :param n: Number of nodes
+    :param pairs: Flat array with the two node ids of each edge
+    :return: Array with the root of each node, the smallest node id in its component
+    """
+    parent = array("q", range(n))
+    for i in range(0, len(pairs), 2):
+        union(parent, pairs[i], pairs[i + 1])
+    for node in range(n):
+        parent[node] = find_root(parent, node)
+    return parent
+
+
+def collect_nodes(args, names, pairs, data):
+    """
+    Writes the lines of each connected component as one block.
+    Components come in order of their first appearance in the input, and the edges
+    of a component in order of first appearance, so the output is reproducible.
+    :param args:
+    :param names: Name of each node id
+    :param pairs: Flat array with the two node ids of each edge
+    :param data: Lines of each edge id
+    :return: roots (array, root of each node) and blocks (root of each written block)
+    """
+    roots = find_components(len(names), pairs)
+    order = sorted(range(len(data)), key=lambda edge: roots[pairs[2 * edge]])
+    blocks = []
+    with open_output(args) as fout:
+        for edge in order:
+            if not blocks or roots[pairs[2 * edge]] != blocks[-1]:
+                blocks.append(roots[pairs[2 * edge]])
+                fout.write("#------------------------\n")
+            for line in data[edge]:
+                fout.write("{}\n".format(line))
+    return roots, blocks
+
+
+# Largest number of spill files open at the same time
+MAX_MERGE = 256
+
+
+def write_spill(records, name):
+    """
+    Writes sorted (root, line number, line) records to a spill file
+    :return: None
+    """
+    with open(name, "w") as fout:
+        for root, lineno, line in records:
+            fout.write("{}\t{}\t{}\n".format(root, lineno, line))
+
+
+def spill(chunk, tmpdir, spills):
+    """
+    Sorts a chunk of (root, line number, line) and writes it to a new spill file
+    :return: None
+    """
+    chunk.sort()
+    name = os.path.join(tmpdir, "spill{}.txt".format(len(spills)))
+    write_spill(chunk, name)
+    spills.append(name)
+    chunk.clear()
+
+
+def read_spill(name):
+    with open(name, "r") as fin:
+        for line in fin:
+            root, lineno, line = line.rstrip("\n").split("\t", 2)
+            yield int(root), int(lineno), line
+
+
+def merge_spills(spills, tmpdir):
+    """
+    Merges spill files in several passes until at most MAX_MERGE are left, so the
+    number of open files stays below the limit of the system
+    :param spills: Names of spill files, list is updated
+    :return: Generator of all records, sorted
+    """
+    merged = 0
+    while len(spills) > MAX_MERGE:
+        group = spills[:MAX_MERGE]
+        del spills[:MAX_MERGE]
+        name = os.path.join(tmpdir, "merged{}.txt".format(merged))
+        merged += 1
+        write_spill(heapq.merge(*[read_spill(spilled) for spilled in group]), name)
+        for spilled in group:
+            os.remove(spilled)
+        spills.append(name)
+    return heapq.merge(*[read_spill(name) for name in spills])
+
+
+def collect_nodes_stream(args):
+    """
+    Groups the lines by connected component in two passes over the input, keeping only
+    the node names in memory. The first pass builds the union-find over the node names,
+    the second pass labels each line with its component and writes sorted spill files,
+    which are merged into the output. Components come in the same order as with
+    collect_nodes, lines within a component in input order.
+    :param args:
+    :return: names, parent (union-find array) and blocks (root of each written block)
+    """
+    ids = {}
+    parent = array("q")
+    for l, name1, name2 in iter_alignments(args.infile, args.columns):
+        for name in (name1, name2):
+            if name not in ids:
+                ids[name] = len(ids)
+                parent.append(ids[name])
+        union(parent, ids[name1], ids[name2])
+    print("Sequences: {}".format(len(ids)))
+    outdir = os.path.dirname(os.path.abspath(args.output))
+    with tempfile.TemporaryDirectory(dir=outdir) as tmpdir:
+        spills, chunk = [], []
+        for lineno, (l, name1, name2) in enumerate(
+            iter_alignments(args.infile, args.columns)
+        ):
+            chunk.append((find_root(parent, ids[name1]), lineno, "\t".join(l)))
+            if len(chunk) >= args.chunksize:
+                spill(chunk, tmpdir, spills)
+        if chunk:
+            spill(chunk, tmpdir, spills)
+        blocks = []
+        with open_output(args) as fout:
+            for root, lineno, line in merge_spills(spills, tmpdir):
+                if not blocks or root != blocks[-1]:
+                    blocks.append(root)
+                    fout.write("#------------------------\n")
+                fout.write("{}\n".format(line))
+    return list(ids), parent, blocks
+
+
+def block_offsets(filename):
+    """
+    Finds the byte ranges of the blocks in a grouped file
+    :param filename: Grouped file, blocks start with a '#' line
+    :return: List of (start, end)
+    """
+    offsets = []
+    pos = 0
+    with open(filename, "rb") as fin:
+        for line in fin:
+            if line.startswith(b"#"):
+                if offsets:
+                    offsets[-1][1] = pos
+                offsets.append([pos, None])
+            pos += len(line)
+    if offsets:
+        offsets[-1][1] = pos
+    return [tuple(o) for o in offsets]
+
+
+def save_state(statefile, output, names, parent, blocks):
+    """
+    Saves the union-find and the byte range of each component in the grouped output,
+    for later incremental updates
+    :param statefile: Name of state file
+    :param output: Grouped file
+    :param names: Name of each node id
+    :param parent: Union-find array
+    :param blocks: Root of each block in the grouped file, in file order
+    :return: None
+    """
+    for node in range(len(parent)):
+        parent[node] = find_root(parent, node)
+    state = {
+        "names": names,
+        "parent": parent,
+        "blocks": dict(zip(blocks, block_offsets(output))),
+    }
+    with open(statefile, "wb") as fout:
+        pickle.dump(state, fout, protocol=pickle.HIGHEST_PROTOCOL)
+
 
+def copy_range(fin, fout, start, end, size=1 << 20):
+    fin.seek(start)
+    while start < end:
+        data = fin.read(min(size, end - start))
+        fout.write(data)
+        start += len(data)
 
-def collect_nodes(args, tree, data):
-    with open(args.output, "w") as fout:
-        while len(tree) > 0:
-            first = random.choice(list(tree.keys()))
-            fout.write("#------------------------\n")
-            go_wide(tree, first, data, fout)
+
+def update_groups(args):
+    """
+    Adds new alignments to an existing grouped file. Only the components that get new
+    lines are rewritten; they are moved to the end of the file, all other blocks are
+    copied unchanged. The state file (see save_state) is updated.
+    :param args:
+    :return: None
+    """
+    with open(args.state, "rb") as fin:
+        state = pickle.load(fin)
+    names, parent, blocks = state["names"], state["parent"], state["blocks"]
+    ids = {name: node for node, name in enumerate(names)}
+    old_roots = array("q", parent)
+    affected = set()
+    lines = []
+    for l, name1, name2 in iter_alignments(args.infile, args.columns):
+        for name in (name1, name2):
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+                parent.append(ids[name])
+            elif ids[name] < len(old_roots):
+                affected.add(old_roots[ids[name]])
+        union(parent, ids[name1], ids[name2])
+        lines.append((ids[name1], "\t".join(l)))
+    del ids
+    print("New lines: {}, components changed: {}".format(len(lines), len(affected)))
+    merged = {}
+    new_blocks = {}
+    tmpfile = "{}.tmp".format(args.output)
+    with open(args.output, "rb") as fin, open(tmpfile, "wb") as fout:
+        pos = 0
+        pending = None
+        for root, (start, end) in sorted(blocks.items(), key=lambda item: item[1][0]):
+            if root in affected:
+                fin.seek(start)
+                data = fin.read(end - start).split(b"\n", 1)[1]
+                merged.setdefault(find_root(parent, root), []).append(data)
+                continue
+            # Consecutive unchanged blocks are copied in one go
+            if pending is not None and pending[1] != start:
+                copy_range(fin, fout, *pending)
+                pending = None
+            if pending is None:
+                pending = [start, end]
+            pending[1] = end
+            new_blocks[root] = (pos, pos + end - start)
+            pos += end - start
+        if pending is not None:
+            copy_range(fin, fout, *pending)
+        for node, line in lines:
+            merged.setdefault(find_root(parent, node), []).append(
+                "{}\n".format(line).encode()
+            )
+        for root in sorted(merged):
+            start = pos
+            pos += fout.write(b"#------------------------\n")
+            for data in merged[root]:
+                pos += fout.write(data)
+            new_blocks[root] = (start, pos)
+    os.replace(tmpfile, args.output)
+    for node in range(len(parent)):
+        parent[node] = find_root(parent, node)
+    state = {"names": names, "parent": parent, "blocks": new_blocks}
+    with open(args.state, "wb") as fout:
+        pickle.dump(state, fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def filter_chunk(lines, blocks, args):
+    """
+    Filters the alignments of a chunk of blocks (see read_blocks), and formats the blocks
+    with more than one sequence in 1 (A) or in 2 (B).
+    Removes hits with sequence identity below --min-identity, and short hits (below
+    --min-length bp) that don't amount to --min-coverage coverage.
+    :param lines: Alignment lines
+    :param blocks: List of (block number, number of lines)
+    :param args:
+    :return: (text for the A file, text for the B file)
+    """
+    c1, c2 = [int(c) - 1 for c in args.columns.split(",")]
+    df = pd.read_csv(
+        io.StringIO("".join(lines)),
+        sep=r"\s+",
+        header=None,
+        dtype=str,
+        usecols=sorted({c1, c2, c2 + 2, 11, 13}),
+        keep_default_na=False,
+        na_filter=False,
+    )
+    identity = df[11].str.partition("/")
+    coverage = df[13].str.partition("/")
+    ia, ib = [identity[i].astype("int64").to_numpy() for i in (0, 2)]
+    ca, cb = [coverage[i].astype("int64").to_numpy() for i in (0, 2)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        keep = ~(ia / ib < args.min_identity) & ~(
+            (ca < args.min_length) & (ca / cb < args.min_coverage)
+        )
+    rows = np.flatnonzero(keep)
+    block = np.repeat(
+        np.array([b[0] for b in blocks], dtype=np.int64), [b[1] for b in blocks]
+    )[rows]
+    kept = pd.DataFrame(
+        {
+            "block": block,
+            "name1": df[c1].to_numpy()[rows],
+            "name2": df[c2].to_numpy()[rows],
+            "size": df[c2 + 2].astype("int64").to_numpy()[rows],
+        }
+    )
+    # Distinct sequences in each block, with the size of the first hit of each
+    stats = []
+    for name in ("name1", "name2"):
+        g = kept.drop_duplicates(["block", name]).groupby("block")["size"]
+        counts, sizes = g.count(), g.sum()
+        stats.append(
+            {b: (n, int(t)) for b, n, t in zip(counts.index, counts.tolist(), sizes.tolist())}
+        )
+    textA, textB = [], []
+    ids, starts = np.unique(block, return_index=True)
+    ends = list(starts[1:]) + [len(rows)]
+    for b, start, end in zip(ids.tolist(), starts.tolist(), ends):
+        items = "".join([lines[i] for i in rows[start:end].tolist()])
+        for (n, total), text in zip((stats[0][b], stats[1][b]), (textA, textB)):
+            if n > 1:
+                text.append("#{};{}------------------------\n".format(n, total))
+                text.append(items)
+    return "".join(textA), "".join(textB)
 
 
 def filter_nodes(args):
     """
-    Remove
+    Remove alignments that fail the identity and coverage filters (see filter_chunk), and
+    write the blocks with more than one sequence in 1 to prefix.A.txt and the blocks with
+    more than one sequence in 2 to prefix.B.txt
     :param args:
     :return: None
     """
@@ -78,53 +426,113 @@ def filter_nodes(args):
         fullname = args.infile
     else:
         fullname = args.output
-    prefix = fullname.rsplit(".", 1)[0]
-    fileA = "{}.A.txt".format(prefix)
-    fileB = "{}.B.txt".format(prefix)
-    c1, c2 = [int(c) - 1 for c in args.columns.split(",")]
-    with open(fullname, "r") as fin, open(fileA, "w") as foutA, open(
-        fileB, "w"
-    ) as foutB:
-        lines = {}
-        dbA, dbB = [], []
-        for line in fin:
-            # Next block starts
-            if line.startswith("#"):
-                if len(dbA) > 1:
-                    foutA.write(
-                        "#{};{}------------------------\n".format(len(dbA), sum(sizesA))
-                    )
-                if len(dbB) > 1:
-                    foutB.write(
-                        "#{};{}------------------------\n".format(len(dbB), sum(sizesB))
-                    )
-                for items in lines:
-                    if len(dbA) > 1:
-                        foutA.write(items)
-                    if len(dbB) > 1:
-                        foutB.write(items)
-                lines, dbA, dbB = [], [], []
-                sizesA, sizesB = [], []
-                continue
-            l = line.strip().split()
-            # Filter out very short hits (less than 500 bp, if this doesn't amount to above 80% coverage.
-            # Filter out hits with seq ID < 98%
-            a, b = [int(x) for x in l[11].split("/")]
-            if (a / b) < 0.98:
-                continue
-            a, b = [int(x) for x in l[13].split("/")]
-            if a < 500 and (a / b) < 0.8:
-                continue
-            lines.append(line)
-            name1, name2 = l[c1], l[c2]
-            if name1 not in dbA:
-                dbA.append(name1)
-                sizesA.append(int(l[c2 + 2]))
-            if name2 not in dbB:
-                dbB.append(l[c2])
-                sizesB.append(int(l[c2 + 2]))
-        foutA.write("#------------------------\n")
-        foutB.write("#------------------------\n")
+    with FilterWriter(fullname.rsplit(".", 1)[0], args) as fout:
+        for lines, blocks in read_blocks(fullname, args.chunksize, trailing=True):
+            fout.write_chunk(lines, blocks)
+
+
+class FilterWriter:
+    """
+    Writes filtered blocks to the A and B files. Can also be used in place of the grouped
+    output file, filtering the blocks as they are written.
+    """
+
+    def __init__(self, prefix, args):
+        self.args = args
+        self.foutA = open("{}.A.txt".format(prefix), "w")
+        self.foutB = open("{}.B.txt".format(prefix), "w")
+        self.chunk, self.blocks, self.block, self.coll = [], [], 0, 0
+
+    def write_chunk(self, lines, blocks):
+        textA, textB = filter_chunk(lines, blocks, self.args)
+        self.foutA.write(textA)
+        self.foutB.write(textB)
+
+    def _end_block(self):
+        if self.block > 0:
+            self.blocks.append((self.coll, self.block))
+            self.coll += 1
+            self.block = 0
+        if len(self.chunk) >= self.args.chunksize:
+            self.write_chunk(self.chunk, self.blocks)
+            self.chunk, self.blocks = [], []
+
+    def write(self, text):
+        if text.startswith("#"):
+            self._end_block()
+        else:
+            self.chunk.append(text)
+            self.block += 1
+
+    def close(self):
+        self._end_block()
+        if self.chunk:
+            self.write_chunk(self.chunk, self.blocks)
+        self.foutA.write("#------------------------\n")
+        self.foutB.write("#------------------------\n")
+        self.foutA.close()
+        self.foutB.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(args):
+    """
+    Opens the grouped output, or a FilterWriter when the filter is fused into the grouping
+    :param args:
+    :return: File-like object
+    """
+    if args.fused:
+        return FilterWriter(args.output.rsplit(".", 1)[0], args)
+    return open(args.output, "w")
+
+
+COLUMNS = [
+    "score",
+    "name1",
+    "strand1",
+    "size1",
+    "zstart1",
+    "end1",
+    "name2",
+    "strand2",
+    "size2",
+    "zstart2",
+    "end2",
+    "identity",
+    "idPct",
+    "coverage",
+    "covPct",
+]
+INT_COLUMNS = ["size1", "zstart1", "end1", "size2", "zstart2", "end2"]
+
+
+def sort_keys(df):
+    if "block" in df.columns:
+        return ["block", "name2", "zstart2+"]
+    return ["name2", "zstart2+"]
+
+
+def bridges(df):
+    """
+    Marks the rows that, together with the row before, bridge two contigs: the two rows
+    are on the same sequence in 2 but on different sequences in 1 (and in the same block,
+    if there is a block column)
+    :param df: Alignments, sorted by (block,) name2 and zstart2+
+    :return: Boolean array, one value per row
+    """
+    name1 = df["name1"].to_numpy()
+    name2 = df["name2"].to_numpy()
+    mask = np.zeros(len(df), dtype=bool)
+    mask[1:] = (name2[1:] == name2[:-1]) & (name1[1:] != name1[:-1])
+    if "block" in df.columns:
+        block = df["block"].to_numpy()
+        mask[1:] &= block[1:] == block[:-1]
+    return mask
 
 
 def clean_df(df):
@@ -133,118 +541,155 @@ def clean_df(df):
     :param df:
     :return:
     """
-    df = df.sort_values(["name2", "zstart2+"])
+    df = df.sort_values(sort_keys(df))
     df = df.reset_index(drop=True)
-    deleted = list(df.index)
-    prow = None
-    for ind, row in df.iterrows():
-        if prow is None:
-            prow = row
-            continue
-        if (row["name2"] == prow["name2"]) and (row["name1"] != prow["name1"]):
-            try:
-                deleted.pop(deleted.index(ind))
-            except (IndexError, ValueError):
-                pass
-            try:
-                deleted.pop(deleted.index(ind - 1))
-            except (IndexError, ValueError):
-                pass
-        prow = row
-    df = df.drop(df.index[deleted])
-    return df
+    mask = bridges(df)
+    keep = mask.copy()
+    keep[:-1] |= mask[1:]
+    return df[keep]
 
 
-def build_scf(args, df, coll):
-    with open(args.output, "a") as fout:
-        df = df.sort_values(["name2", "zstart2+"])
-        df = df.reset_index(drop=True)
-        if args.verbose > 0:
-            print(df)
-        for ind, row in df.iterrows():
-            # We're working on pairs, so just store the first and move on
-            if ind == 0:
-                prow = row
-                continue
-            # The two lines have to be from the same sequence in 2 but different sequence in 1
-            if (prow["name2"] != row["name2"]) or (prow["name1"] == row["name1"]):
-                prow = row
-                continue
-            # The distance from the end of the first section to the beginning of the second section
-            gap = row["zstart2+"] - prow["end2+"]
-            # Determining the orientation of the two sections
-            if prow["strand2"] == "-":
-                pre1 = [prow["zstart1"], "-"]
-            else:
-                pre1 = [prow["size1"] - prow["end1"], "+"]
-            if row["strand2"] == "-":
-                post1 = [row["size1"] - row["end1"], "-"]
-            else:
-                post1 = [row["zstart1"], "+"]
-            overlap = gap - (pre1[0] + post1[0])
-            fout.write(
-                "{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                    coll, prow["name1"], pre1[1], overlap, row["name1"], post1[1]
-                )
-            )
-            prow = row
+def scf_lines(df, coll=None):
+    """
+    Formats one line for each pair of consecutive rows that bridges two contigs
+    :param df: Alignments, sorted by (block,) name2 and zstart2+
+    :param coll: Block number, default is the block column
+    :return: List of output lines
+    """
+    mask = bridges(df)
+    cur = np.flatnonzero(mask)
+    prev = cur - 1
+    zstart1 = df["zstart1"].to_numpy()
+    end1 = df["end1"].to_numpy()
+    size1 = df["size1"].to_numpy()
+    minus = df["strand2"].to_numpy() == "-"
+    # The distance from the end of the first section to the beginning of the second section
+    gap = df["zstart2+"].to_numpy()[cur] - df["end2+"].to_numpy()[prev]
+    # Determining the orientation of the two sections
+    pre = np.where(minus[prev], zstart1[prev], size1[prev] - end1[prev])
+    post = np.where(minus[cur], size1[cur] - end1[cur], zstart1[cur])
+    overlap = gap - (pre + post)
+    name1 = df["name1"].to_numpy()
+    if coll is None:
+        colls = df["block"].to_numpy()[cur].tolist()
+    else:
+        colls = [coll] * len(cur)
+    return [
+        "{}\t{}\t{}\t{}\t{}\t{}\n".format(
+            c, n1, "-" if m1 else "+", o, n2, "-" if m2 else "+"
+        )
+        for c, n1, m1, o, n2, m2 in zip(
+            colls,
+            name1[prev].tolist(),
+            minus[prev].tolist(),
+            overlap.tolist(),
+            name1[cur].tolist(),
+            minus[cur].tolist(),
+        )
+    ]
 
 
-def build_scaffolds(args):
-    c1, c2 = [int(c) - 1 for c in args.columns.split(",")]
-    with open(args.output, "w") as fout:
-        pass
-    coll = 0
-    with open(args.infile, "r") as fin:
-        lines = []
+def read_blocks(infile, chunklines, trailing=False):
+    """
+    Reads a grouped file in chunks of whole blocks. Empty blocks are not numbered.
+    :param infile: Grouped file, blocks start (and end) with a '#' line
+    :param chunklines: Approximate number of lines in each chunk
+    :param trailing: Lines after the last '#' line are a block, otherwise they are skipped
+    :return: Generator of (lines, [(block number, number of lines), ...])
+    """
+    chunk, blocks, block, coll = [], [], [], 0
+    with open(infile, "r") as fin:
         for line in fin:
-            if line.startswith("#"):
-                if len(lines) > 0:
-                    df = pd.DataFrame(
-                        lines,
-                        columns=[
-                            "score",
-                            "name1",
-                            "strand1",
-                            "size1",
-                            "zstart1",
-                            "end1",
-                            "name2",
-                            "strand2",
-                            "size2",
-                            "zstart2",
-                            "end2",
-                            "identity",
-                            "idPct",
-                            "coverage",
-                            "covPct",
-                            "zstart2+",
-                            "end2+",
-                        ],
-                    )
-                    df = df.astype(
-                        dtype={
-                            "zstart2": "int64",
-                            "end2": "int64",
-                            "size2": "int64",
-                            "zstart1": "int64",
-                            "end1": "int64",
-                            "size1": "int64",
-                        }
-                    )
-                    df = clean_df(df)
-                    build_scf(args, df, coll)
-                    coll += 1
-                lines = []
+            if not line.startswith("#"):
+                block.append(line)
                 continue
-            l = line.strip().split()
-            if l[7] == "-":
-                l.append(int(l[8]) - int(l[10]))
-                l.append(int(l[8]) - int(l[9]))
-            else:
-                l.append(int(l[9]))
-                l.append(int(l[10]))
-            lines.append(l)
+            if block:
+                chunk.extend(block)
+                blocks.append((coll, len(block)))
+                coll += 1
+                block = []
+            if len(chunk) >= chunklines:
+                yield chunk, blocks
+                chunk, blocks = [], []
+    if block and trailing:
+        chunk.extend(block)
+        blocks.append((coll, len(block)))
+    if chunk:
+        yield chunk, blocks
+
+
+def parse_chunk(lines, blocks):
+    """
+    Parses alignment lines into typed columns and adds the block number and the
+    coordinates on the forward strand of sequence 2 (zstart2+, end2+)
+    :param lines: Alignment lines
+    :param blocks: List of (block number, number of lines)
+    :return: DataFrame
+    """
+    dtype = {c: "int64" if c in INT_COLUMNS else str for c in COLUMNS}
+    df = pd.read_csv(
+        io.StringIO("".join(lines)),
+        sep=r"\s+",
+        header=None,
+        names=COLUMNS,
+        dtype=dtype,
+        keep_default_na=False,
+        na_filter=False,
+    )
+    df["block"] = np.repeat(
+        np.array([b[0] for b in blocks], dtype=np.int64), [b[1] for b in blocks]
+    )
+    minus = (df["strand2"] == "-").to_numpy()
+    size2 = df["size2"].to_numpy()
+    zstart2 = df["zstart2"].to_numpy()
+    end2 = df["end2"].to_numpy()
+    df["zstart2+"] = np.where(minus, size2 - end2, zstart2)
+    df["end2+"] = np.where(minus, size2 - zstart2, end2)
+    return df
+
+
+def scaffold_chunk(lines, blocks, verbose=0):
+    """
+    Builds the scaffold lines of a chunk of blocks, see read_blocks
+    :return: Output text
+    """
+    df = clean_df(parse_chunk(lines, blocks))
+    if verbose > 0:
+        print(df)
+    return "".join(scf_lines(df))
+
+
+def build_scaffolds(args):
+    """
+    Finds pairs of contigs in 1 that are bridged by alignments to the same sequence in 2,
+    for every block. The grouped file is parsed in large chunks of whole blocks, and each
+    chunk is handled as one grouped operation. With several jobs, the chunks are split
+    into smaller tasks, about four for each process, which are sent to a pool of
+    processes. The results are written in block order, and the lines of the tasks in
+    flight stay within --chunksize.
+    :param args:
+    :return: None
+    """
+    if args.jobs <= 1:
+        with open(args.output, "w") as fout:
+            for lines, blocks in read_blocks(args.infile, args.chunksize):
+                fout.write(scaffold_chunk(lines, blocks, args.verbose))
+        return
+    tasks = read_blocks(args.infile, max(1, args.chunksize // (4 * args.jobs)))
+    with open(args.output, "w") as fout, multiprocessing.Pool(args.jobs) as pool:
+        pending = deque()
+        inflight = 0
+        for lines, blocks in tasks:
+            while pending and inflight + len(lines) > args.chunksize:
+                result, n = pending.popleft()
+                fout.write(result.get())
+                inflight -= n
+            pending.append(
+                (pool.apply_async(scaffold_chunk, (lines, blocks, args.verbose)), len(lines))
+            )
+            inflight += len(lines)
+        while pending:
+            fout.write(pending.popleft()[0].get())
 
 
 def main(args):
@@ -254,11 +699,22 @@ def main(args):
         build_scaffolds(args)
     elif args.filter:
         filter_nodes(args)
+    elif args.update:
+        print("Updating groups")
+        update_groups(args)
+    elif args.stream:
+        print("Collecting groups, streaming")
+        names, parent, blocks = collect_nodes_stream(args)
+        if args.state:
+            save_state(args.state, args.output, names, parent, blocks)
     else:
         print("Reading nodes")
-        tree, data = read_nodes(args)
+        names, pairs, data = read_nodes(args)
         print("Collecting groups")
-        collect_nodes(args, tree, data)
+        parent, blocks = collect_nodes(args, names, pairs, data)
+        if args.state:
+            del data
+            save_state(args.state, args.output, names, parent, blocks)
     if args.log:
         with open("README.txt", "a") as fout:
             fout.write("[{}]\t[{}]\n".format(time.asctime(), " ".join(sys.argv)))
@@ -289,6 +745,61 @@ if __name__ == "__main__":
     parser.add_argument(
         "-b", "--build", action="store_true", default=False, help="Only run build step"
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Group lines in two passes, with bounded memory",
+    )
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        default=False,
+        help="Add the alignments in infile to the grouped output (needs --state)",
+    )
+    parser.add_argument(
+        "--state", help="State file, for incremental updates of the grouped output"
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        default=False,
+        help="Filter while grouping, writing only the .A.txt and .B.txt files",
+    )
+    parser.add_argument(
+        "--min-identity",
+        type=float,
+        default=0.98,
+        help="Filter: minimum sequence identity of a hit",
+    )
+    parser.add_argument(
+        "--min-length",
+        type=int,
+        default=500,
+        help="Filter: hits shorter than this need --min-coverage",
+    )
+    parser.add_argument(
+        "--min-coverage",
+        type=float,
+        default=0.8,
+        help="Filter: minimum coverage of short hits",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes for the build step",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1000000,
+        help="Lines held in memory at a time (with --stream and --build), shared by "
+        "the tasks in flight with --jobs",
+    )
 
     # Optional argument which requires a parameter (eg. -d test)
     parser.add_argument("-o", "--output", help="Output file")
@@ -307,4 +818,8 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    if args.update and args.state is None:
+        parser.error("--update needs the state file of the grouped output (--state)")
+    if args.fused and (args.state or args.update):
+        parser.error("--fused writes no grouped output, it can't be used with --state")
     main(args)
@@ -13,7 +13,643 @@ import argparse
 import time
 import sys
 import os.path
+import re
+import signal
+import socket
+import socketserver
+import sqlite3
 import gzip
+import io
+import json
+import mmap
+import multiprocessing
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+
+
+REVCOMP = bytes.maketrans(b"ACGTacgt", b"TGCAtgca")
+
+
+def read_bed(bedfile):
+    """
+    Reads a bedfile into a dictionary with one list of intervals per sequence
+    :param bedfile: Name of bedfile with sequence coordinates
+    :return: {chrom: [(name, start, end, strand), ...]}
+    """
+    bed = {}
+    with open(bedfile, "r") as fin:
+        for line in fin:
+            l = line.strip().split()
+            if len(l) == 6:
+                chrom, start, end, name, score, strand = l
+            elif len(l) == 4:
+                chrom, start, end, name = l
+                strand = "+"
+            elif len(l) == 3:
+                chrom, start, end = l
+                name = "{}:{}-{}".format(chrom, start, end)
+                strand = "+"
+            elif len(l) == 1:
+                chrom = l[0]
+                start = end = 0
+                name = "{}:{}-{}".format(chrom, start, end)
+                strand = "+"
+            else:
+                continue
+            if chrom not in bed:
+                bed[chrom] = []
+            bed[chrom].append((name, int(start), int(end), strand))
+    return bed
+
+
+def build_fai(fastafile, faifile=None):
+    """
+    Writes an index of the fasta file, compatible with 'samtools faidx'
+    Columns: name, length, offset of first base, bases per line, bytes per line
+    Offsets of compressed files are in uncompressed bytes
+    :param fastafile: Input fastafile, plain text or bgzip-compressed
+    :param faifile: Name of index file, default is fastafile + ".fai"
+    :return: Index, see read_fai
+    """
+    if faifile is None:
+        faifile = "{}.fai".format(fastafile)
+    index = {}
+    name = None
+    offset = 0
+    if fastafile[-3:] == ".gz":
+        op = gzip.open
+    else:
+        op = open
+    with op(fastafile, "rb") as fin:
+        for line in fin:
+            offset += len(line)
+            if line.startswith(b">"):
+                name = line[1:].strip().split()[0].decode()
+                index[name] = [0, offset, 0, 0]
+                short = ended = False
+                continue
+            if name is None:
+                continue
+            bases = len(line.rstrip(b"\r\n"))
+            if bases == 0:
+                # Blank lines end the sequence, as between records
+                ended = True
+                continue
+            entry = index[name]
+            if ended:
+                raise ValueError(
+                    "Blank line within sequence '{}', can not index the file".format(name)
+                )
+            if entry[2] == 0:
+                entry[2], entry[3] = bases, len(line)
+            elif short or bases > entry[2]:
+                # Only the last line of a sequence can be shorter than the others
+                raise ValueError(
+                    "Different line lengths within sequence '{}', "
+                    "can not index the file".format(name)
+                )
+            short = bases < entry[2]
+            entry[0] += bases
+    with open(faifile, "w") as fout:
+        for name, (length, offset, linebases, linewidth) in index.items():
+            fout.write(
+                "{}\t{}\t{}\t{}\t{}\n".format(name, length, offset, linebases, linewidth)
+            )
+    return {name: tuple(entry) for name, entry in index.items()}
+
+
+def read_fai(fastafile, build=True):
+    """
+    Reads the .fai index of a fastafile, builds the index if it is missing
+    :param fastafile: Input fastafile, plain text or bgzip-compressed
+    :param build: Create the index when it does not exist
+    :return: {name: (length, offset, linebases, linewidth)}
+    """
+    faifile = "{}.fai".format(fastafile)
+    if not os.path.isfile(faifile) or os.path.getmtime(faifile) < os.path.getmtime(
+        fastafile
+    ):
+        if not build:
+            return None
+        return build_fai(fastafile, faifile)
+    index = {}
+    with open(faifile, "r") as fin:
+        for line in fin:
+            name, length, offset, linebases, linewidth = line.strip().split("\t")[0:5]
+            index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+    return index
+
+
+def is_bgzf(fastafile):
+    """
+    Checks if a file is bgzip-compressed (blocked gzip), rather than plain gzip
+    :param fastafile: Input file
+    :return: True/False
+    """
+    with open(fastafile, "rb") as fin:
+        header = fin.read(18)
+    return (
+        len(header) == 18
+        and header[0:4] == b"\x1f\x8b\x08\x04"
+        and header[12:14] == b"BC"
+    )
+
+
+def read_bgzf_block(fh):
+    """
+    Reads and decompresses the BGZF block at the current position of the file
+    :param fh: Open compressed file, binary mode
+    :return: (compressed size, uncompressed data), compressed size is 0 at end of file
+    """
+    header = fh.read(12)
+    if len(header) < 12:
+        return 0, b""
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = fh.read(xlen)
+    bsize = None
+    pos = 0
+    while pos < xlen:
+        slen = struct.unpack("<H", extra[pos + 2 : pos + 4])[0]
+        if extra[pos : pos + 2] == b"BC":
+            bsize = struct.unpack("<H", extra[pos + 4 : pos + 6])[0] + 1
+        pos += 4 + slen
+    if bsize is None:
+        raise ValueError("Not a BGZF block, file must be compressed with bgzip")
+    cdata = fh.read(bsize - 12 - xlen)
+    return bsize, zlib.decompress(cdata[:-8], -15)
+
+
+def build_gzi(fastafile, gzifile=None):
+    """
+    Writes the block index of a bgzip-compressed file, compatible with 'bgzip -r'
+    The index holds the compressed and uncompressed start offsets of every block but the first
+    :param fastafile: Input fastafile, bgzip-compressed
+    :param gzifile: Name of index file, default is fastafile + ".gzi"
+    :return: List of (compressed offset, uncompressed offset), including the first block
+    """
+    if gzifile is None:
+        gzifile = "{}.gzi".format(fastafile)
+    blocks = []
+    coffset, uoffset = 0, 0
+    with open(fastafile, "rb") as fin:
+        while True:
+            header = fin.read(18)
+            if len(header) < 18:
+                break
+            if header[12:14] != b"BC":
+                raise ValueError("Not a BGZF block, file must be compressed with bgzip")
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            fin.seek(coffset + bsize - 4)
+            isize = struct.unpack("<I", fin.read(4))[0]
+            blocks.append((coffset, uoffset))
+            coffset += bsize
+            uoffset += isize
+    with open(gzifile, "wb") as fout:
+        fout.write(struct.pack("<Q", len(blocks) - 1))
+        for block in blocks[1:]:
+            fout.write(struct.pack("<QQ", *block))
+    return blocks
+
+
+def read_gzi(fastafile, build=True):
+    """
+    Reads the .gzi block index of a bgzip-compressed file, builds the index if it is missing
+    :param fastafile: Input fastafile, bgzip-compressed
+    :param build: Create the index when it does not exist
+    :return: List of (compressed offset, uncompressed offset), including the first block
+    """
+    gzifile = "{}.gzi".format(fastafile)
+    if not os.path.isfile(gzifile) or os.path.getmtime(gzifile) < os.path.getmtime(
+        fastafile
+    ):
+        if not build:
+            return None
+        return build_gzi(fastafile, gzifile)
+    with open(gzifile, "rb") as fin:
+        n = struct.unpack("<Q", fin.read(8))[0]
+        data = fin.read(16 * n)
+    return [(0, 0)] + list(struct.iter_unpack("<QQ", data))
+
+
+class BgzfReader:
+    """
+    Read-only, seekable view of the uncompressed content of a bgzip-compressed file
+    Only the blocks overlapping a read are decompressed
+    """
+
+    def __init__(self, filename, blocks):
+        self.fh = open(filename, "rb")
+        self.coffsets = [b[0] for b in blocks]
+        self.uoffsets = [b[1] for b in blocks]
+        self.pos = 0
+        self.cache = (None, b"")
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def _block(self, i):
+        if self.cache[0] != i:
+            # pread leaves the shared file position alone, for use in forked processes
+            data = os.pread(self.fh.fileno(), 65536, self.coffsets[i])
+            self.cache = (i, read_bgzf_block(io.BytesIO(data))[1])
+        return self.cache[1]
+
+    def read(self, size):
+        i = bisect_right(self.uoffsets, self.pos) - 1
+        chunks = []
+        while size > 0 and i < len(self.coffsets):
+            data = self._block(i)
+            chunk = data[self.pos - self.uoffsets[i] : self.pos - self.uoffsets[i] + size]
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+            i += 1
+        return b"".join(chunks)
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_fasta(fastafile):
+    """
+    Opens a plain text (memory mapped) or bgzip-compressed fastafile for random access
+    :param fastafile: Input fastafile
+    :return: File-like object, binary mode, seek/read use uncompressed offsets
+    """
+    if fastafile[-3:] == ".gz":
+        return BgzfReader(fastafile, read_gzi(fastafile))
+    if os.path.getsize(fastafile) == 0:
+        return open(fastafile, "rb")
+    with open(fastafile, "rb") as fin:
+        return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def fai_offset(entry, pos):
+    """
+    Byte offset in the fastafile of a position in a sequence
+    :param entry: Index entry (length, offset, linebases, linewidth)
+    :param pos: Position in the sequence, 0-based
+    :return: Byte offset
+    """
+    length, offset, linebases, linewidth = entry
+    return offset + (pos // linebases) * linewidth + pos % linebases
+
+
+def fai_title(fh, entry):
+    """
+    Reads the title line of a sequence in an indexed fastafile, it ends just before the
+    offset of the first base
+    :param fh: Open fastafile, see open_fasta
+    :param entry: Index entry (length, offset, linebases, linewidth)
+    :return: Title line as bytes, with '>' and line ending
+    """
+    end = entry[1]
+    size = 256
+    while True:
+        first = max(0, end - size)
+        fh.seek(first)
+        data = fh.read(end - first)
+        i = data.rfind(b"\n", 0, len(data) - 1)
+        if i >= 0:
+            return data[i + 1 :]
+        if first == 0:
+            return data
+        size *= 4
+
+
+def fetch_region(fh, entry, start, end):
+    """
+    Reads a part of a sequence directly from an indexed fastafile
+    :param fh: Open fastafile, see open_fasta
+    :param entry: Index entry (length, offset, linebases, linewidth)
+    :param start: Start coordinate, 0-based. (inclusive)
+    :param end: End coordinate, 0-based. (exclusive), 0 means end of sequence
+    :return: Sequence as bytes
+    """
+    length = entry[0]
+    if end == 0 or end > length:
+        end = length
+    start = max(start, 0)
+    if start >= end:
+        return b""
+    first = fai_offset(entry, start)
+    fh.seek(first)
+    data = fh.read(fai_offset(entry, end - 1) - first + 1)
+    return data.replace(b"\n", b"").replace(b"\r", b"")
+
+
+TWOBIT_SIGNATURE = 0x1A412743
+TWOBIT_PACK = bytearray(b"0" * 256)
+for base, code in zip(b"TCAGtcag", b"01230123"):
+    TWOBIT_PACK[base] = code
+TWOBIT_PACK = bytes(TWOBIT_PACK)
+TWOBIT_UNPACK = str.maketrans(
+    {
+        "{:x}".format(i): "TCAG"[i >> 2] + "TCAG"[i & 3]
+        for i in range(16)
+    }
+)
+
+
+def fasta_to_twobit(fastafile, twobitfile):
+    """
+    Converts a fastafile into the UCSC .2bit format, 4 bases per byte
+    Runs of bases other than ACGT are stored as N-blocks and lower case as mask-blocks.
+    Only one sequence is kept in memory at a time.
+    :param fastafile: Input fastafile, plain text or gzip-compressed
+    :param twobitfile: Name of output file
+    :return: None
+    """
+    if fastafile[-3:] == ".gz":
+        op = gzip.open
+    else:
+        op = open
+
+    def records():
+        name, seq = None, []
+        with op(fastafile, "rb") as fin:
+            for line in fin:
+                if line.startswith(b">"):
+                    if name is not None:
+                        yield name, b"".join(seq)
+                    name, seq = line[1:].strip().split()[0], []
+                elif name is not None:
+                    seq.append(line.rstrip(b"\r\n"))
+        if name is not None:
+            yield name, b"".join(seq)
+
+    # The index with all names comes before the sequences
+    with op(fastafile, "rb") as fin:
+        names = [line[1:].strip().split()[0] for line in fin if line.startswith(b">")]
+    offset = 16 + sum(5 + len(name) for name in names)
+    with open(twobitfile, "wb") as fout:
+        fout.write(struct.pack("<IIII", TWOBIT_SIGNATURE, 0, len(names), 0))
+        fout.write(b"\0" * (offset - 16))
+        offsets = []
+        for name, seq in records():
+            offsets.append(offset)
+            nblocks = [m.span() for m in re.finditer(rb"[^ACGTacgt]+", seq)]
+            mblocks = [m.span() for m in re.finditer(rb"[a-z]+", seq)]
+            header = struct.pack("<II", len(seq), len(nblocks))
+            header += array("I", [b[0] for b in nblocks]).tobytes()
+            header += array("I", [b[1] - b[0] for b in nblocks]).tobytes()
+            header += struct.pack("<I", len(mblocks))
+            header += array("I", [b[0] for b in mblocks]).tobytes()
+            header += array("I", [b[1] - b[0] for b in mblocks]).tobytes()
+            header += struct.pack("<I", 0)
+            codes = seq.translate(TWOBIT_PACK) + b"0" * (-len(seq) % 4)
+            packed = int(codes, 4).to_bytes(len(codes) // 4, "big") if codes else b""
+            fout.write(header)
+            fout.write(packed)
+            offset += len(header) + len(packed)
+        fout.seek(16)
+        for name, offset in zip(names, offsets):
+            fout.write(struct.pack("<B", len(name)) + name + struct.pack("<I", offset))
+
+
+def read_twobit(twobitfile):
+    """
+    Memory maps a .2bit file and reads the index and block lists of all sequences
+    :param twobitfile: Input .2bit file
+    :return: (mmap, {name: (length, dna offset, nstarts, nsizes, mstarts, msizes)})
+    """
+    with open(twobitfile, "rb") as fin:
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    if struct.unpack("<I", mm[0:4])[0] == TWOBIT_SIGNATURE:
+        order = "<"
+    elif struct.unpack(">I", mm[0:4])[0] == TWOBIT_SIGNATURE:
+        order = ">"
+    else:
+        raise ValueError("'{}' is not a .2bit file".format(twobitfile))
+
+    def blocks(pos):
+        n = struct.unpack(order + "I", mm[pos : pos + 4])[0]
+        starts = array("I", mm[pos + 4 : pos + 4 + 4 * n])
+        sizes = array("I", mm[pos + 4 + 4 * n : pos + 4 + 8 * n])
+        if (order == "<") != (sys.byteorder == "little"):
+            starts.byteswap()
+            sizes.byteswap()
+        return list(starts), list(sizes), pos + 4 + 8 * n
+
+    count = struct.unpack(order + "I", mm[8:12])[0]
+    index = {}
+    pos = 16
+    for _ in range(count):
+        size = mm[pos]
+        name = mm[pos + 1 : pos + 1 + size].decode()
+        offset = struct.unpack(order + "I", mm[pos + 1 + size : pos + 5 + size])[0]
+        pos += 5 + size
+        length = struct.unpack(order + "I", mm[offset : offset + 4])[0]
+        nstarts, nsizes, nxt = blocks(offset + 4)
+        mstarts, msizes, nxt = blocks(nxt)
+        index[name] = (length, nxt + 4, nstarts, nsizes, mstarts, msizes)
+    return mm, index
+
+
+def fetch_twobit(mm, entry, start, end):
+    """
+    Reads a part of a sequence from a memory mapped .2bit file
+    :param mm: Memory mapped .2bit file, see read_twobit
+    :param entry: Index entry of the sequence
+    :param start: Start coordinate, 0-based. (inclusive)
+    :param end: End coordinate, 0-based. (exclusive), 0 means end of sequence
+    :return: Sequence as bytes
+    """
+    length, offset, nstarts, nsizes, mstarts, msizes = entry
+    if end == 0 or end > length:
+        end = length
+    start = max(start, 0)
+    if start >= end:
+        return b""
+    packed = mm[offset + start // 4 : offset + (end + 3) // 4]
+    first = start % 4
+    seq = bytearray(packed.hex().translate(TWOBIT_UNPACK)[first : first + end - start], "ascii")
+    for starts, sizes, mask in ((nstarts, nsizes, False), (mstarts, msizes, True)):
+        i = max(bisect_right(starts, start) - 1, 0)
+        while i < len(starts) and starts[i] < end:
+            b0 = max(starts[i], start) - start
+            b1 = min(starts[i] + sizes[i], end) - start
+            if b1 > b0:
+                if mask:
+                    seq[b0:b1] = seq[b0:b1].lower()
+                else:
+                    seq[b0:b1] = b"N" * (b1 - b0)
+            i += 1
+    return bytes(seq)
+
+
+def twobit_cache(fastafile):
+    """
+    Name of the .2bit copy of a fastafile, the copy is created if it is missing or outdated
+    :param fastafile: Input fastafile, plain text or gzip-compressed
+    :return: Name of .2bit file
+    """
+    twobitfile = "{}.2bit".format(fastafile)
+    if not os.path.isfile(twobitfile) or os.path.getmtime(
+        twobitfile
+    ) < os.path.getmtime(fastafile):
+        fasta_to_twobit(fastafile, twobitfile)
+    return twobitfile
+
+
+# {fastafile: (mtime, (index, fetch, title), open file or memory map)}
+_opened = {}
+
+
+def open_indexed(fastafile):
+    """
+    Opens a fastafile for random access, either a .2bit file or a fastafile with a .fai index
+    Opened files are kept open and reused by later calls in the same process, until the
+    file is rewritten
+    :param fastafile: Input fastafile, plain text, bgzip-compressed or .2bit
+    :return: (index, fetch, title), index is {name: entry} in file order, with the sequence
+             length as the first item of each entry. fetch(entry, start, end) returns bytes,
+             title(name, entry) returns the title line as bytes ('>name' for .2bit files).
+    """
+    mtime = os.path.getmtime(fastafile)
+    if fastafile in _opened:
+        opened_mtime, opened, fh = _opened[fastafile]
+        if opened_mtime == mtime:
+            return opened
+        del _opened[fastafile]
+        fh.close()
+    if fastafile[-5:] == ".2bit":
+        mm, index = read_twobit(fastafile)
+        opened = (
+            index,
+            lambda entry, start, end: fetch_twobit(mm, entry, start, end),
+            lambda name, entry: ">{}\n".format(name).encode(),
+        )
+        _opened[fastafile] = (mtime, opened, mm)
+    else:
+        index = read_fai(fastafile)
+        fin = open_fasta(fastafile)
+        opened = (
+            index,
+            lambda entry, start, end: fetch_region(fin, entry, start, end),
+            lambda name, entry: fai_title(fin, entry),
+        )
+        _opened[fastafile] = (mtime, opened, fin)
+    return opened
+
+
+def getfasta_indexed(fastafile, match):
+    """
+    Same as getfasta, for an indexed or .2bit fastafile
+    The title lines are read from just before each sequence, and the sequence lines have
+    the same length as in the file, so the output is the same as for getfasta.
+    .2bit files only have the sequence names, and are written with 60 bases per line.
+    :param fastafile: Input fastafile, plain text, bgzip-compressed or .2bit
+    :param match: Function that takes a title line (with '>') and returns True/False
+    :return: NA
+    """
+    index, fetch, title = open_indexed(fastafile)
+    twobit = fastafile[-5:] == ".2bit"
+    for name, entry in index.items():
+        line = title(name, entry).decode()
+        if not match(line):
+            continue
+        seq = fetch(entry, 0, 0).decode()
+        width = 60 if twobit else entry[2] or 60
+        sys.stdout.write(line)
+        for i in range(0, len(seq), width):
+            sys.stdout.write("{}\n".format(seq[i : i + width]))
+
+
+def getpartialfasta_fai(fastafile, pattern, start, end, reverse):
+    """
+    Same as getpartialfasta, but seeks directly to the requested bases using the .fai index
+    or the .2bit file. The title lines are read from just before each sequence, so the
+    output is the same. .2bit files only have the sequence names.
+    :param fastafile: Input fastafile, plain text, bgzip-compressed or .2bit
+    :param pattern: Whole or part of sequence name
+    :param start: Start coordinate, 0-based. (inclusive)
+    :param end: End coordinate, 0-based. (exclusive)
+    :return:
+    """
+    bpattern = pattern.encode()
+    index, fetch, title = open_indexed(fastafile)
+    for name, entry in index.items():
+        line = title(name, entry)
+        if bpattern not in line:
+            continue
+        seq = fetch(entry, max(start, 0), end)
+        if reverse:
+            seq = seq[::-1].translate(REVCOMP)
+        sys.stdout.write("{}{}\n".format(line.decode(), seq.decode()))
+
+
+def bed_records(fetch, entry, intervals):
+    """
+    Extracts a list of bed intervals from one sequence of an indexed fastafile
+    :param fetch: Function returning part of a sequence, see open_indexed
+    :param entry: Index entry of the sequence
+    :param intervals: List of (name, start, end, strand)
+    :return: Fasta records as one string
+    """
+    records = []
+    for (name, start, end, strand) in intervals:
+        seq = fetch(entry, start, end)
+        if strand != "+":
+            seq = seq[::-1].translate(REVCOMP)
+        records.append(">{}\n{}\n".format(name, seq.decode()))
+    return "".join(records)
+
+
+_worker_index = None
+_worker_fetch = None
+
+
+def _init_bed_worker(fastafile):
+    global _worker_index, _worker_fetch
+    _worker_index, _worker_fetch = open_indexed(fastafile)[:2]
+
+
+def _bed_worker(task):
+    # Only the sequence name is sent, the index entry is looked up in the worker
+    chrom, intervals = task
+    return bed_records(_worker_fetch, _worker_index[chrom], intervals)
+
+
+def getbedfasta_fai(fastafile, bedfile, threads=1, chunksize=10000):
+    """
+    Same as getbedfasta, but seeks directly to the requested bases using the .fai index
+    or the .2bit file. Output order is the same as for getbedfasta: sequences in fasta order,
+    and intervals in bedfile order within each sequence, also when using several processes.
+    :param fastafile: Input fastafile, plain text, bgzip-compressed or .2bit
+    :param bedfile: Name of bedfile with sequence coordinates
+    :param threads: Number of processes, chromosome groups are split between them
+    :param chunksize: Maximum number of intervals sent to a process at a time
+    :return:
+    """
+    bed = read_bed(bedfile)
+    index, fetch = open_indexed(fastafile)[:2]
+    tasks = (
+        (chrom, bed[chrom][i : i + chunksize])
+        for chrom in index
+        if chrom in bed
+        for i in range(0, len(bed[chrom]), chunksize)
+    )
+    if threads > 1:
+        with multiprocessing.Pool(
+            threads, initializer=_init_bed_worker, initargs=(fastafile,)
+        ) as pool:
+            for records in pool.imap(_bed_worker, tasks):
+                sys.stdout.write(records)
+    else:
+        for chrom, intervals in tasks:
+            sys.stdout.write(bed_records(fetch, index[chrom], intervals))
 
 
 def getfasta(fastafile, pattern, full=False, reverse=False):
@@ -40,48 +676,297 @@ def getfasta(fastafile, pattern, full=False, reverse=False):
                 sys.stdout.write(line)
 
 
-def getpartialfasta(fastafile, pattern, start, end, reverse):
+def build_automaton(patterns):
     """
-    Sends sequence selection of any sequence with name matching pattern to stdout
+    Builds an Aho-Corasick automaton for finding any of several substrings in one pass
+    :param patterns: List of substrings
+    :return: (goto, fail, hit), one entry per state
+    """
+    goto, fail, hit = [{}], [0], [False]
+    for pattern in patterns:
+        state = 0
+        for ch in pattern:
+            if ch not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                hit.append(False)
+                goto[state][ch] = len(goto) - 1
+            state = goto[state][ch]
+        hit[state] = True
+    queue = list(goto[0].values())
+    for state in queue:
+        for ch, nxt in goto[state].items():
+            queue.append(nxt)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            hit[nxt] = hit[nxt] or hit[fail[nxt]]
+    return goto, fail, hit
+
+
+def automaton_search(automaton, text):
+    """
+    Checks if any of the patterns of the automaton occurs in the text
+    :param automaton: See build_automaton
+    :param text: String to search
+    :return: True/False
+    """
+    goto, fail, hit = automaton
+    if hit[0]:
+        return True
+    state = 0
+    for ch in text:
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        if hit[state]:
+            return True
+    return False
+
+
+def read_matcher(patternfile, full=False):
+    """
+    Reads a file of names into a function for checking sequence titles
+    :param patternfile: File with one name or substring per line
+    :param full: The whole title must match one of the names
+    :return: Function that takes a title and returns True/False
+    """
+    with open(patternfile, "r") as fin:
+        patterns = [line.strip() for line in fin if line.strip() != ""]
+    if full:
+        names = set(patterns)
+        return lambda title: title in names
+    automaton = build_automaton(patterns)
+    return lambda title: automaton_search(automaton, title)
+
+
+def getfastamulti(fastafile, patternfile, full=False):
+    """
+    Sends any sequence with name matching one of the patterns to stdout, in a single pass
     :param fastafile: Input fastafile, plain text
-    :param pattern: Whole or part of sequence name
-    :param start: Start coordinate, 0-based. (inclusive)
-    :param end: End coordinate, 0-based. (exclusive)
-    :return:
+    :param patternfile: File with one name or substring per line
+    :param full: The whole title must match one of the names
+    :return: NA
     """
-    trans = str.maketrans("ACGTacgt", "TGCAtgca")
+    match = read_matcher(patternfile, full)
     active = False
     if fastafile[-3:] == ".gz":
         op = gzip.open
     else:
         op = open
-    seq = ""
     with op(fastafile, "rt") as fin:
         for line in fin:
             if line.startswith(">"):
+                active = match(line.strip()[1:])
                 if active:
-                    if not reverse:
-                        sys.stdout.write("{}\n".format(seq[start:end]))
-                    else:
-                        sys.stdout.write(
-                            "{}\n".format(seq[start:end][::-1].translate(trans))
-                        )
-                    seq = ""
-                if pattern in line:
-                    active = True
                     sys.stdout.write(line)
-                else:
-                    active = False
             elif active:
-                seq += line.strip()
+                sys.stdout.write(line)
+
+
+FASTA_SUFFIXES = (".fa", ".fasta", ".fna", ".fas", ".fa.gz", ".fasta.gz", ".fna.gz", ".fas.gz")
+
+
+def build_header_db(dbfile, directory):
+    """
+    Records title, file, byte offset and length of every sequence in all fastafiles
+    below a directory in an SQLite database. Offsets are in uncompressed bytes.
+    Files that have not changed since the last build are not read again.
+    :param dbfile: Name of database file, created if missing
+    :param directory: Directory with fastafiles
+    :return: None
+    """
+    db = sqlite3.connect(dbfile)
+    db.execute("CREATE TABLE IF NOT EXISTS files (file TEXT PRIMARY KEY, mtime REAL, size INTEGER)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS headers "
+        "(title TEXT, name TEXT, file TEXT, offset INTEGER, length INTEGER)"
+    )
+    # --full looks up the whole title
+    db.execute("DROP INDEX IF EXISTS headers_name")
+    db.execute("CREATE INDEX IF NOT EXISTS headers_title ON headers (title)")
+    db.execute("CREATE INDEX IF NOT EXISTS headers_file ON headers (file)")
+    known = {f: (m, n) for f, m, n in db.execute("SELECT file, mtime, size FROM files")}
+    found = set()
+    for root, dirs, files in os.walk(os.path.abspath(directory)):
+        for filename in sorted(files):
+            if not filename.endswith(FASTA_SUFFIXES):
+                continue
+            fastafile = os.path.join(root, filename)
+            found.add(fastafile)
+            stat = os.stat(fastafile)
+            if known.get(fastafile) == (stat.st_mtime, stat.st_size):
+                continue
+            db.execute("DELETE FROM headers WHERE file = ?", (fastafile,))
+            if fastafile[-3:] == ".gz":
+                op = gzip.open
+            else:
+                op = open
+            rows = []
+            offset, start, title = 0, 0, None
+            with op(fastafile, "rb") as fin:
+                for line in fin:
+                    if line.startswith(b">"):
+                        if title is not None:
+                            rows.append((title, title.split()[0], fastafile, start, offset - start))
+                        title = line[1:].strip().decode()
+                        start = offset
+                    offset += len(line)
+            if title is not None:
+                rows.append((title, title.split()[0], fastafile, start, offset - start))
+            db.executemany("INSERT INTO headers VALUES (?, ?, ?, ?, ?)", rows)
+            db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                (fastafile, stat.st_mtime, stat.st_size),
+            )
+    for fastafile in set(known) - found:
+        db.execute("DELETE FROM headers WHERE file = ?", (fastafile,))
+        db.execute("DELETE FROM files WHERE file = ?", (fastafile,))
+    db.commit()
+    db.close()
+
+
+def getfasta_db(dbfile, pattern, full=False, regex=False):
+    """
+    Sends any sequence with title matching the pattern to stdout, only reading the
+    fastafiles that contain a match, according to the header database.
+    :param dbfile: Database made by build_header_db
+    :param pattern: Whole or part of sequence title, or a regular expression
+    :param full: The whole title must match the pattern
+    :param regex: Pattern is a regular expression
+    :return: NA
+    """
+    db = sqlite3.connect(dbfile)
+    if regex:
+        expr = re.compile(pattern)
+        db.create_function(
+            "REGEXP", 2, lambda p, title: expr.search(title) is not None, deterministic=True
+        )
+        where = "title REGEXP ?"
+    elif full:
+        where = "title = ?"
+    else:
+        where = "instr(title, ?) > 0"
+    rows = db.execute(
+        "SELECT file, offset, length FROM headers WHERE {} ORDER BY file, offset".format(
+            where
+        ),
+        (pattern,),
+    ).fetchall()
+    db.close()
+    fin, current = None, None
+    for fastafile, offset, length in rows:
+        if fastafile != current:
+            if fin is not None:
+                fin.close()
+            if fastafile[-3:] == ".gz" and is_bgzf(fastafile):
+                fin = BgzfReader(fastafile, read_gzi(fastafile))
+            elif fastafile[-3:] == ".gz":
+                fin = gzip.open(fastafile, "rb")
+            else:
+                fin = open(fastafile, "rb")
+            current = fastafile
+        fin.seek(offset)
+        sys.stdout.write(fin.read(length).decode())
+    if fin is not None:
+        fin.close()
+
+
+def merge_intervals(intervals):
+    """
+    Sorts and merges overlapping intervals
+    :param intervals: List of (start, end), 0-based, end exclusive
+    :return: Sorted list of non-overlapping [start, end]
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
         else:
-            if active:
-                if not reverse:
-                    sys.stdout.write("{}\n".format(seq[start:end]))
-                else:
-                    sys.stdout.write(
-                        "{}\n".format(seq[start:end][::-1].translate(trans))
-                    )
+            merged.append([start, end])
+    return merged
+
+
+def stream_fasta(fastafile, select):
+    """
+    Reads the fastafile once and keeps only the parts of each sequence that are requested
+    :param fastafile: Input fastafile, plain text or gzip-compressed
+    :param select: Function taking a title line (bytes), returning a list of (start, end)
+                   to extract from that sequence, or None to skip it.
+                   Coordinates are 0-based, end exclusive, sys.maxsize for end of sequence.
+    :return: Generator of (title line, [sequence (bytes) for each requested interval])
+    """
+    if fastafile[-3:] == ".gz":
+        op = gzip.open
+    else:
+        op = open
+
+    def extract():
+        starts = [seg[0] for seg in segments]
+        out = []
+        for start, end in intervals:
+            i = bisect_right(starts, start) - 1
+            if start >= end or i < 0:
+                out.append(b"")
+                continue
+            s0 = segments[i][0]
+            out.append(bytes(buffers[i][start - s0 : end - s0]))
+        return out
+
+    title = None
+    with op(fastafile, "rb") as fin:
+        for line in fin:
+            if line.startswith(b">"):
+                if title is not None:
+                    yield title, extract()
+                intervals = select(line)
+                title = None
+                if intervals is not None:
+                    title = line
+                    segments = merge_intervals(intervals)
+                    buffers = [bytearray() for seg in segments]
+                    pos, k = 0, 0
+                continue
+            if title is None:
+                continue
+            seq = line.rstrip(b"\r\n")
+            end = pos + len(seq)
+            while k < len(segments) and segments[k][1] <= pos:
+                k += 1
+            j = k
+            while j < len(segments) and segments[j][0] < end:
+                s0, e0 = segments[j]
+                buffers[j] += seq[max(s0 - pos, 0) : min(e0, end) - pos]
+                j += 1
+            pos = end
+        if title is not None:
+            yield title, extract()
+
+
+def getpartialfasta(fastafile, pattern, start, end, reverse):
+    """
+    Sends sequence selection of any sequence with name matching pattern to stdout
+    :param fastafile: Input fastafile, plain text
+    :param pattern: Whole or part of sequence name
+    :param start: Start coordinate, 0-based. (inclusive)
+    :param end: End coordinate, 0-based. (exclusive)
+    :return:
+    """
+    bpattern = pattern.encode()
+    start = max(start, 0)
+
+    def select(title):
+        if bpattern in title:
+            return [(start, end)]
+        return None
+
+    for title, (seq,) in stream_fasta(fastafile, select):
+        if reverse:
+            seq = seq[::-1].translate(REVCOMP)
+        sys.stdout.write("{}{}\n".format(title.decode(), seq.decode()))
 
 
 def getbedfasta(fastafile, bedfile):
@@ -91,84 +976,200 @@ def getbedfasta(fastafile, bedfile):
     :param bedfile: Name of bedfile with sequence coordinates
     :return:
     """
-    bed = {}
-    with open(bedfile, "r") as fin:
-        for line in fin:
-            l = line.strip().split()
-            if len(l) == 6:
-                chrom, start, end, name, score, strand = l
-            elif len(l) == 4:
-                chrom, start, end, name = l
-                strand = "+"
-            elif len(l) == 3:
-                chrom, start, end = l
-                name = "{}:{}-{}".format(chrom, start, end)
-                strand = "+"
-            elif len(l) == 1:
-                chrom = l[0]
-                start = end = 0
-                name = "{}:{}-{}".format(chrom, start, end)
-                strand = "+"
-            else:
-                continue
-            if chrom not in bed:
-                bed[chrom] = []
-            bed[chrom].append((name, int(start), int(end), strand))
-    trans = str.maketrans("ACGTacgt", "TGCAtgca")
-    active = False
-    if fastafile[-3:] == ".gz":
-        op = gzip.open
+    bed = read_bed(bedfile)
+
+    def select(title):
+        chrom = title[1:].strip().split()[0].decode()
+        if chrom not in bed:
+            return None
+        return [(start, end or sys.maxsize) for (name, start, end, strand) in bed[chrom]]
+
+    for title, seqs in stream_fasta(fastafile, select):
+        chrom = title[1:].strip().split()[0].decode()
+        for (name, start, end, strand), seq in zip(bed[chrom], seqs):
+            if strand != "+":
+                seq = seq[::-1].translate(REVCOMP)
+            sys.stdout.write(">{}\n{}\n".format(name, seq.decode()))
+
+
+def run_query(args):
+    """
+    Runs one extraction, output is sent to stdout
+    :param args: Parsed command line arguments
+    :return: None
+    """
+    if args.twobit and args.fastafile[-5:] != ".2bit":
+        args.fastafile = twobit_cache(args.fastafile)
+    if args.fastafile[-5:] == ".2bit":
+        args.index = True
+    if args.index and args.fastafile[-3:] == ".gz" and not is_bgzf(args.fastafile):
+        sys.stderr.write(
+            "Random access needs a bgzip-compressed file, reading the whole file\n"
+        )
+        args.index = False
+    if args.names:
+        if args.index:
+            match = read_matcher(args.pattern, args.full)
+            getfasta_indexed(args.fastafile, lambda line: match(line.strip()[1:]))
+        else:
+            getfastamulti(args.fastafile, args.pattern, args.full)
+    elif os.path.isfile(args.pattern):
+        if args.index:
+            getbedfasta_fai(args.fastafile, args.pattern, args.threads)
+        else:
+            getbedfasta(args.fastafile, args.pattern)
     else:
-        op = open
-    seq = ""
-    with op(fastafile, "rt") as fin:
-        for line in fin:
-            if line.startswith(">"):
-                if active:
-                    for (name, start, end, strand) in bed[chrom]:
-                        if end == 0:
-                            end = len(seq)
-                        if strand == "+":
-                            sys.stdout.write(">{}\n{}\n".format(name, seq[start:end]))
-                        else:
-                            sys.stdout.write(
-                                ">{}\n{}\n".format(
-                                    name, seq[start:end][::-1].translate(trans)
-                                )
-                            )
-                    seq = ""
-                chrom = line[1:].strip().split()[0]
-                if chrom in bed:
-                    active = True
-                else:
-                    active = False
-            elif active:
-                seq += line.strip()
+        if args.coordinates == "0,0" and args.index:
+            if args.full:
+                getfasta_indexed(
+                    args.fastafile, lambda line: line.strip()[1:] == args.pattern
+                )
+            else:
+                getfasta_indexed(args.fastafile, lambda line: args.pattern in line)
+        elif args.coordinates == "0,0":
+            getfasta(args.fastafile, args.pattern, args.full, args.reverse)
         else:
-            if active:
-                for (name, start, end, strand) in bed[chrom]:
-                    if end == 0:
-                        end = len(seq)
-                    if strand == "+":
-                        sys.stdout.write(">{}\n{}\n".format(name, seq[start:end]))
-                    else:
-                        sys.stdout.write(
-                            ">{}\n{}\n".format(
-                                name, seq[start:end][::-1].translate(trans)
-                            )
-                        )
+            s, e = [int(c) for c in args.coordinates.split(",")]
+            if args.index:
+                getpartialfasta_fai(args.fastafile, args.pattern, s - 1, e, args.reverse)
+            else:
+                getpartialfasta(args.fastafile, args.pattern, s - 1, e, args.reverse)
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """
+    Answers one query: a line with the command line arguments as a JSON object.
+    The reply is the fasta output, followed by a NUL byte and a JSON status object.
+    """
+
+    # Seconds to wait for the query line, in the forked process
+    timeout = 60
+
+    def handle(self):
+        status = {"status": "ok"}
+        try:
+            line = self.rfile.readline()
+        except OSError:
+            return
+        if not line:
+            return
+        sys.stdout = io.TextIOWrapper(self.wfile, encoding="ascii", errors="replace")
+        try:
+            query = argparse.Namespace(**json.loads(line))
+            query.index = True
+            run_query(query)
+        except Exception as e:
+            status = {"status": "error", "message": "{}: {}".format(type(e).__name__, e)}
+        sys.stdout.flush()
+        self.wfile.write(b"\0" + json.dumps(status).encode())
+
+
+def open_preloaded(fastafiles):
+    """
+    Opens fastafiles for random access, as run_query will. Files that were rewritten
+    since they were opened are opened again.
+    :param fastafiles: Fastafiles, absolute paths
+    :return: None
+    """
+    for fastafile in fastafiles:
+        if fastafile[-3:] == ".gz" and not is_bgzf(fastafile):
+            continue
+        open_indexed(fastafile)
+
+
+class ForkingUnixServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Forks one process per query. The preloaded fastafiles are checked before forking,
+    so a rewritten file is opened again in the server process, and the forked process
+    inherits it. Other fastafiles are opened by the forked process.
+    """
+
+    preload = []
+
+    def process_request(self, request, client_address):
+        try:
+            open_preloaded(self.preload)
+        except OSError:
+            pass
+        super().process_request(request, client_address)
+
+
+def serve(socketfile, fastafiles):
+    """
+    Keeps the indexes and memory maps of the fastafiles open and answers queries on a
+    Unix socket, one forked process per query. Queries always use the index.
+    Fastafiles that are not preloaded are opened for each query.
+    :param socketfile: Name of the socket
+    :param fastafiles: Fastafiles to open before accepting queries
+    :return: None
+    """
+    preload = [os.path.abspath(fastafile) for fastafile in fastafiles]
+    open_preloaded(preload)
+    if os.path.exists(socketfile):
+        os.remove(socketfile)
+    server = ForkingUnixServer(socketfile, QueryHandler)
+    server.preload = preload
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketfile)
+
+
+def query_server(socketfile, args):
+    """
+    Sends a query to a running server and copies the reply to stdout
+    :param socketfile: Name of the socket
+    :param args: Parsed command line arguments
+    :return: True if the query succeeded
+    """
+    query = dict(vars(args), log=False, serve=None, connect=None)
+    for key in ("pattern", "fastafile"):
+        if os.path.exists(query[key]):
+            query[key] = os.path.abspath(query[key])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketfile)
+        sock.sendall("{}\n".format(json.dumps(query)).encode())
+        status = None
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            if status is None and b"\0" in chunk:
+                chunk, status = chunk.split(b"\0", 1)
+                sys.stdout.buffer.write(chunk)
+            elif status is None:
+                sys.stdout.buffer.write(chunk)
+            else:
+                status += chunk
+    status = json.loads(status) if status else {"status": "error", "message": "No reply"}
+    if status["status"] != "ok":
+        sys.stderr.write("{}\n".format(status["message"]))
+        return False
+    return True
 
 
 def main(args):
     """ Main entry point of the app """
-    if os.path.isfile(args.pattern):
-        getbedfasta(args.fastafile, args.pattern)
+    if args.serve:
+        serve(args.serve, args.preload or [])
+        return
+    if args.build_db:
+        build_header_db(args.db, args.build_db)
+    elif args.db:
+        getfasta_db(args.db, args.pattern, args.full, args.regex)
+    elif args.connect:
+        if not query_server(args.connect, args):
+            sys.exit(1)
     else:
-        if args.coordinates == "0,0":
-            getfasta(args.fastafile, args.pattern, args.full, args.reverse)
-        else:
-            s, e = [int(c) for c in args.coordinates.split(",")]
-            getpartialfasta(args.fastafile, args.pattern, s - 1, e, args.reverse)
+        try:
+            run_query(args)
+        except ValueError as e:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
     if args.log:
         with open("README.txt", "a") as fout:
             fout.write("[{}]\t[{}]\n".format(time.asctime(), " ".join(sys.argv)))
@@ -178,9 +1179,9 @@ if __name__ == "__main__":
     """ This is executed when run from the command line """
     parser = argparse.ArgumentParser()
 
-    # Required positional argument
-    parser.add_argument("pattern", help="Search pattern or bed-file")
-    parser.add_argument("fastafile", help="Input fasta file")
+    # Required positional argument (not with --serve, --build-db; --db only needs pattern)
+    parser.add_argument("pattern", nargs="?", help="Search pattern or bed-file")
+    parser.add_argument("fastafile", nargs="?", help="Input fasta file")
 
     # Optional argument flag which defaults to False
     parser.add_argument(
@@ -204,6 +1205,34 @@ if __name__ == "__main__":
     parser.add_argument(
         "-r", "--reverse", action="store_true", default=False, help="Reverse strand"
     )
+    parser.add_argument(
+        "-n",
+        "--names",
+        action="store_true",
+        default=False,
+        help="Pattern is a file with one name (or part of name) per line",
+    )
+    parser.add_argument(
+        "-i",
+        "--index",
+        action="store_true",
+        default=False,
+        help="Use .fai (and .gzi for bgzip files) index for random access",
+    )
+    parser.add_argument(
+        "-2",
+        "--twobit",
+        action="store_true",
+        default=False,
+        help="Read from a packed .2bit copy of the fasta file (created if missing)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes for bed extraction (with --index)",
+    )
 
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(
@@ -217,5 +1246,49 @@ if __name__ == "__main__":
         version="%(prog)s (version {version})".format(version=__version__),
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        help="Run as a server, answering queries on this Unix socket",
+    )
+    parser.add_argument(
+        "--preload",
+        metavar="FASTA",
+        nargs="+",
+        help="Fasta files for the server to open before accepting queries (with --serve)",
+    )
+    parser.add_argument(
+        "--connect",
+        metavar="SOCKET",
+        help="Send the query to a server running on this Unix socket",
+    )
+
+    parser.add_argument(
+        "-d", "--db", help="Find sequences through this header database (SQLite)"
+    )
+    parser.add_argument(
+        "--build-db",
+        metavar="DIR",
+        help="Add all fasta files below DIR to the header database given by --db",
+    )
+    parser.add_argument(
+        "-e",
+        "--regex",
+        action="store_true",
+        default=False,
+        help="Pattern is a regular expression (with --db)",
+    )
+
+    # Options may come between the two positional arguments
+    args = parser.parse_intermixed_args()
+    if args.preload and args.serve is None:
+        parser.error("--preload needs --serve")
+    if args.serve and args.pattern is not None:
+        parser.error("with --serve, give the fasta files to open with --preload")
+    if args.build_db and args.db is None:
+        parser.error("--build-db needs the name of the database (--db)")
+    if args.db and args.pattern is None and args.build_db is None:
+        parser.error("the following arguments are required: pattern")
+    if args.serve is None and args.db is None and args.fastafile is None:
+        parser.error("the following arguments are required: pattern, fastafile")
     main(args)
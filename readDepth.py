@@ -8,137 +8,1032 @@ __version__ = "0.1.1"
 __license__ = "MIT"
 
 import argparse
+import contextlib
 import time
 import sys
-from operator import itemgetter
+import os.path
+import gzip
+import itertools
+import multiprocessing
+import shutil
+import struct
+import tempfile
+import zlib
+from array import array
+from collections import deque
 import numpy as np
 
 
-def regions(args):
+def read_bed_index(bedfile):
     """
-    Condenses a read-depth file by calculating the average read depth pr. region
-    :param args:
-    :return:
+    Reads a bedfile into a sorted interval index for each sequence
+    :param bedfile: Bedfile, only the first three columns are used
+    :return: {name: (starts, stops, maxstops)} as arrays, intervals sorted by start, where
+             maxstops[i] is the largest stop among intervals 0..i
     """
     beddb = {}
-    with open(args.bedfile, "r") as fin:
+    with open(bedfile, "r") as fin:
         for line in fin:
             name, start, stop, *rest = line.strip().split()
             if name not in beddb:
-                beddb[name] = []
-            beddb[name].append([int(start), int(stop)])
-    samples = []
-    rname, rstart, rstop = "", 0, 0
-    outfile = "{}.regions.txt".format(args.infile[0].rsplit(".", 1)[0])
-    with open(args.infile[0], "r") as fin, open(outfile, "w") as fout:
-        entry = 0
-        for line in fin:
-            name, pos, *depth = line.strip().split()
-            if name not in beddb:
+                beddb[name] = set()
+            beddb[name].add((int(start), int(stop)))
+    index = {}
+    for name, intervals in beddb.items():
+        intervals = np.array(sorted(intervals), dtype=np.int64).reshape(-1, 2)
+        starts, stops = intervals[:, 0].copy(), intervals[:, 1].copy()
+        index[name] = (starts, stops, np.maximum.accumulate(stops))
+    return index
+
+
+def find_intervals(entry, first, last):
+    """
+    Finds the intervals that overlap a range of positions
+    :param entry: Index of one sequence, see read_bed_index
+    :param first: First position
+    :param last: Last position
+    :return: Array of interval numbers
+    """
+    starts, stops, maxstops = entry
+    # Intervals before lo end before first, intervals from hi on start after last
+    lo = np.searchsorted(maxstops, first, "left")
+    hi = np.searchsorted(starts, last, "right")
+    ids = np.arange(lo, hi)
+    return ids[stops[lo:hi] >= first]
+
+
+def read_bgzf_block(fh):
+    """
+    Reads and decompresses one BGZF block
+    :param fh: File handle at the start of a block
+    :return: Uncompressed data, None at the end of the file
+    """
+    header = fh.read(12)
+    if len(header) < 12:
+        return None
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = fh.read(xlen)
+    bsize = None
+    i = 0
+    while i < xlen:
+        si1, si2, slen = struct.unpack("<BBH", extra[i : i + 4])
+        if si1 == 66 and si2 == 67:
+            bsize = struct.unpack("<H", extra[i + 4 : i + 6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise ValueError("Not a BGZF file")
+    data = fh.read(bsize - xlen - 19)
+    fh.read(8)
+    return zlib.decompress(data, -15)
+
+
+class BgzfLines:
+    """
+    Reads lines from a BGZF file, with seek and tell by virtual offset
+    (block offset << 16 | offset within the uncompressed block)
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, "rb")
+        self.coffset = 0
+        self.block = b""
+        self.pos = 0
+        self._load(0)
+
+    def _load(self, coffset):
+        # Loads the block at coffset, skipping empty blocks
+        self.fh.seek(coffset)
+        while True:
+            self.coffset = self.fh.tell()
+            block = read_bgzf_block(self.fh)
+            if block is None:
+                self.block = b""
+                break
+            if block:
+                self.block = block
+                break
+        self.pos = 0
+
+    def seek(self, voffset):
+        coffset, pos = voffset >> 16, voffset & 0xFFFF
+        if coffset != self.coffset or not self.block:
+            self._load(coffset)
+        self.pos = pos
+
+    def tell(self):
+        return (self.coffset << 16) | self.pos
+
+    def readline(self):
+        parts = []
+        while self.block:
+            i = self.block.find(b"\n", self.pos)
+            end = len(self.block) if i < 0 else i + 1
+            parts.append(self.block[self.pos : end])
+            self.pos = end
+            if self.pos == len(self.block):
+                self._load(self.fh.tell())
+            if i >= 0:
+                break
+        return b"".join(parts).decode()
+
+    def close(self):
+        self.fh.close()
+
+
+def read_tabix(tbifile):
+    """
+    Reads the linear index of a tabix index (.tbi)
+    :param tbifile: Name of index file
+    :return: {name: [virtual offset of first record in each 16 kb window]}, settings
+             (0-based sequence and position columns, meta character)
+    """
+    with gzip.open(tbifile, "rb") as fin:
+        data = fin.read()
+    if data[:4] != b"TBI\x01":
+        raise ValueError("Not a tabix index: {}".format(tbifile))
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack(
+        "<8i", data[4:36]
+    )
+    names = data[36 : 36 + l_nm].split(b"\0")[:n_ref]
+    offset = 36 + l_nm
+    index = {}
+    for name in names:
+        n_bin = struct.unpack("<i", data[offset : offset + 4])[0]
+        offset += 4
+        for b in range(n_bin):
+            n_chunk = struct.unpack("<i", data[offset + 4 : offset + 8])[0]
+            offset += 8 + 16 * n_chunk
+        n_intv = struct.unpack("<i", data[offset : offset + 4])[0]
+        offset += 4
+        index[name.decode()] = array("Q", data[offset : offset + 8 * n_intv])
+        offset += 8 * n_intv
+    return index, (col_seq - 1, col_beg - 1, chr(meta))
+
+
+def tabix_lines(depthfile, index):
+    """
+    Reads the lines of a bgzip-compressed, tabix-indexed depth file that overlap the
+    intervals in the bed index. Only the blocks holding these lines are decompressed.
+    Sequences are read in file order.
+    :param depthfile: Depth file, with a .tbi index
+    :param index: Bed index, see read_bed_index
+    :return: Generator of lines
+    """
+    linear, (col_seq, col_pos, meta) = read_tabix(depthfile + ".tbi")
+    reader = BgzfLines(depthfile)
+    try:
+        for name, offsets in linear.items():
+            if name not in index or len(offsets) == 0:
                 continue
-            pos = int(pos)
-            if len(samples) == 0:
-                samples = [0] * len(depth)
-            if rname == "" or rname != name or pos > rstop:
-                if rname != "":
-                    fout.write(
-                        "{}\t{}\t{}\t{}\n".format(
-                            rname,
-                            rstart,
-                            rstop,
-                            "\t".join([str(s / entry) for s in samples]),
-                        )
-                    )
-                    samples = [0] * len(depth)
-                for ind, el in enumerate(beddb[name]):
-                    if pos >= el[0] and pos <= el[1]:
-                        rstart, rstop = beddb[name].pop(ind)
-                        rname = name
-                        entry = 0
-                        break
+            starts, stops, maxstops = index[name]
+            # Merge overlapping intervals
+            clusters = []
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                if clusters and start <= clusters[-1][1] + 1:
+                    clusters[-1][1] = max(clusters[-1][1], stop)
+                else:
+                    clusters.append([start, stop])
+            # A line read but not used by the previous cluster, and its virtual offset
+            pending, pending_offset = None, None
+            seen = done = False
+            for start, stop in clusters:
+                # Windows are 16 kb, from 0-based positions
+                window = max(start - 1, 0) >> 14
+                if window >= len(offsets):
+                    break
+                if pending is None or offsets[window] > pending_offset:
+                    reader.seek(offsets[window])
+                    pending = None
+                while True:
+                    if pending is not None:
+                        voffset, line, pending = pending_offset, pending, None
                     else:
-                        rname, rstart, rstop = "", 0, 0
-                        entry = 0
-                if rname == "":
+                        voffset = reader.tell()
+                        line = reader.readline()
+                    if line == "":
+                        done = True
+                        break
+                    if line.startswith(meta):
+                        continue
+                    fields = line.split("\t", max(col_seq, col_pos) + 1)
+                    if fields[col_seq] != name:
+                        # Lines before the sequence are skipped, after it we are done
+                        if seen:
+                            done = True
+                            break
+                        continue
+                    seen = True
+                    pos = int(fields[col_pos])
+                    if pos > stop:
+                        pending, pending_offset = line, voffset
+                        break
+                    if pos >= start:
+                        yield line
+                if done:
+                    break
+    finally:
+        reader.close()
+
+
+def depth_lines(depthfile, index):
+    """
+    Opens a depth file: plain text, gzip-compressed, or bgzip-compressed with a tabix
+    index (only the lines overlapping the bed index are read)
+    :param depthfile: Depth file
+    :param index: Bed index, see read_bed_index
+    :return: Iterable of lines, with a close() method
+    """
+    if os.path.exists(depthfile + ".tbi"):
+        return tabix_lines(depthfile, index)
+    if depthfile.endswith(".gz"):
+        return gzip.open(depthfile, "rt")
+    return open(depthfile, "r")
+
+
+def parse_depth(lines):
+    """
+    Parses lines of a depth file
+    The name column is split off, and the numbers of all lines are parsed at once by
+    the C parser of np.fromstring.
+    :param lines: List of lines: name, position, depth of each sample
+    :return: names (array), positions (array), depths (2D array, one row per line)
+    """
+    fields = [line.split(None, 1) for line in lines]
+    names = np.array([f[0] for f in fields])
+    text = " ".join([f[1] for f in fields])
+    values = np.fromstring(text, dtype=np.int64, sep=" ").reshape(len(lines), -1)
+    return names, values[:, 0], values[:, 1:]
+
+
+def line_chunks(fin, chunksize):
+    """
+    Reads a file in chunks of lines
+    :param fin: Open file, or other iterable of lines
+    :param chunksize: Number of lines in each chunk
+    :return: Generator of lists of lines
+    """
+    while True:
+        chunk = list(itertools.islice(fin, chunksize))
+        if not chunk:
+            break
+        yield chunk
+
+
+def interval_sums(d, r0, r1):
+    """
+    Sums of the rows r0[i]:r1[i] of a matrix, for many ranges that may overlap
+    The rows between consecutive range boundaries are summed with np.add.reduceat, and
+    the sum of each range is a difference of cumulative sums of these segments.
+    :param d: Matrix
+    :param r0: Array of first rows
+    :param r1: Array of last rows (exclusive)
+    :return: Matrix of sums, one row per range
+    """
+    points = np.union1d(r0, r1)
+    if points[-1] < len(d):
+        points = np.append(points, len(d))
+    cum = np.zeros((len(points), d.shape[1]), dtype=np.int64)
+    if len(points) > 1:
+        np.cumsum(np.add.reduceat(d, points[:-1], axis=0), axis=0, out=cum[1:])
+    return cum[np.searchsorted(points, r1)] - cum[np.searchsorted(points, r0)]
+
+
+def hist_quantiles(keys, counts, nbins, qs):
+    """
+    Quantiles from sparse histograms of integer depths, with linear interpolation as in
+    np.percentile. Exact as long as no depth is in the last bin.
+    :param keys: Bin numbers (sample * nbins + depth) of the nonzero bins, sorted. Every
+                 sample must have at least one bin
+    :param counts: Number of depths in each bin
+    :param nbins: Number of bins pr. sample
+    :param qs: Quantiles, between 0 and 1
+    :return: List with an array of values for each quantile
+    """
+    sample, depth = np.divmod(keys, nbins)
+    cum = np.cumsum(counts, dtype=np.int64)
+    last = np.append(np.flatnonzero(sample[1:] != sample[:-1]), len(sample) - 1)
+    end = cum[last]
+    start = np.append(0, end[:-1])
+    n = end - start
+    values = []
+    for q in qs:
+        pos = q * (n - 1)
+        lo = np.floor(pos)
+        # The depth at rank k is the first bin where more than k depths have been counted
+        vlo = depth[np.searchsorted(cum, start + lo, "right")]
+        vhi = depth[np.searchsorted(cum, start + np.ceil(pos), "right")]
+        values.append(vlo + (vhi - vlo) * (pos - lo))
+    return values
+
+
+def cache_dir(textfile):
+    """
+    Binary cache of a text file: x.regions.txt -> x.regions.cache
+    """
+    return "{}.cache".format(textfile.rsplit(".", 1)[0])
+
+
+def open_cache(textfile, member):
+    """
+    Finds the binary cache of a text file, if it exists and is not older than the file
+    :param textfile: Name of text file, it does not need to exist
+    :param member: File in the cache that must exist, eg. 'matrix.npy'
+    :return: Name of cache directory, or None
+    """
+    directory = cache_dir(textfile)
+    filename = os.path.join(directory, member)
+    if not os.path.exists(filename):
+        return None
+    if os.path.exists(textfile):
+        if os.path.getmtime(filename) < os.path.getmtime(textfile):
+            return None
+    return directory
+
+
+def write_npy(filename, fh, dtype, shape):
+    """
+    Writes a .npy file from raw data in an open file
+    """
+    fh.seek(0)
+    with open(filename, "wb") as fout:
+        np.lib.format.write_array_header_1_0(
+            fout,
+            {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                "fortran_order": False,
+                "shape": shape,
+            },
+        )
+        shutil.copyfileobj(fh, fout)
+
+
+def write_keys(directory, keys):
+    """
+    Writes region keys to a cache: names.npy (sequence names) and keys.npy (sequence
+    number, start, stop of each region)
+    :param directory: Cache directory
+    :param keys: [(name, start, stop)]
+    """
+    names = {}
+    table = np.array(
+        [
+            (names.setdefault(name, len(names)), int(start), int(stop))
+            for name, start, stop in keys
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    np.save(os.path.join(directory, "names.npy"), np.array(list(names), dtype=str))
+    np.save(os.path.join(directory, "keys.npy"), table)
+
+
+def read_keys(directory):
+    """
+    Reads region keys from a cache, see write_keys
+    :return: [(name, start, stop)], as strings like when read from text
+    """
+    names = np.load(os.path.join(directory, "names.npy")).tolist()
+    table = np.load(os.path.join(directory, "keys.npy"))
+    return [(names[n], str(start), str(stop)) for n, start, stop in table.tolist()]
+
+
+class RegionCache:
+    """
+    Writes the binary cache of a regions file: region keys (see write_keys) and
+    matrix.npy, the average depths as float64, the same numbers as in the text file.
+    Rows are written to temporary files as they come, and the .npy files made when the
+    number of rows is known.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.names = {}
+        self.keys = tempfile.TemporaryFile(dir=directory)
+        self.matrix = tempfile.TemporaryFile(dir=directory)
+        self.rows = 0
+        self.samples = 0
+
+    def add(self, name, start, stop, values):
+        n = self.names.setdefault(name, len(self.names))
+        self.keys.write(np.array([n, start, stop], dtype=np.int64).tobytes())
+        self.matrix.write(np.array(values, dtype=np.float64).tobytes())
+        self.samples = len(values)
+        self.rows += 1
+
+    def close(self):
+        names = np.array(list(self.names), dtype=str)
+        np.save(os.path.join(self.directory, "names.npy"), names)
+        write_npy(
+            os.path.join(self.directory, "keys.npy"), self.keys, np.int64, (self.rows, 3)
+        )
+        write_npy(
+            os.path.join(self.directory, "matrix.npy"),
+            self.matrix,
+            np.float64,
+            (self.rows, self.samples),
+        )
+        self.keys.close()
+        self.matrix.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def chunk_sums(lines, index, stats=False, maxdepth=1000):
+    """
+    Parses a chunk of depth lines and sums the depths within each region
+    :param lines: List of lines of a depth file
+    :param index: Bed index, see read_bed_index
+    :param stats: Also sum the squared depths, and count the depths in a histogram
+    :param maxdepth: Largest depth with its own histogram bin
+    :return: List of runs of lines from the same sequence:
+             (name, last position, [[interval, count, sums(, squares, histogram)]]),
+             where the histogram is a list of (bin numbers, counts) of its nonzero bins,
+             see hist_quantiles
+    """
+    names, pos, depth = parse_depth(lines)
+    nbins = maxdepth + 1
+    runs = []
+    bounds = np.flatnonzero(names[1:] != names[:-1]) + 1
+    bounds = [0] + bounds.tolist() + [len(names)]
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        name = str(names[a])
+        if name not in index:
+            continue
+        p = pos[a:b]
+        ids = find_intervals(index[name], p[0], p[-1])
+        parts = []
+        if len(ids) > 0:
+            d = depth[a:b]
+            r0 = np.searchsorted(p, index[name][0][ids], "left")
+            r1 = np.searchsorted(p, index[name][1][ids], "right")
+            sums = [interval_sums(d, r0, r1)]
+            if stats:
+                sums.append(interval_sums(d * d, r0, r1))
+                # Bin number of each depth, offset by sample
+                bins = np.minimum(d, maxdepth) + np.arange(d.shape[1]) * nbins
+                bins = bins.astype(np.int32)
+            for i, n, lo, hi, *s in zip(
+                ids.tolist(), (r1 - r0).tolist(), r0.tolist(), r1.tolist(), *sums
+            ):
+                if n == 0:
                     continue
-            for i, e in enumerate(depth):
-                samples[i] += int(e)
-            entry += 1
-        if rname != "":
-            fout.write(
-                "{}\t{}\t{}\t{}\n".format(
-                    rname, rstart, rstop, "\t".join([str(s / entry) for s in samples])
+                if stats:
+                    keys, counts = np.unique(bins[lo:hi], return_counts=True)
+                    s.append([(keys, counts.astype(np.int32))])
+                parts.append([i, n] + s)
+        runs.append((name, int(p[-1]), parts))
+    return runs
+
+
+def _init_regions_worker(bedfile, stats, maxdepth):
+    global _worker_index, _worker_stats, _worker_maxdepth
+    _worker_index = read_bed_index(bedfile)
+    _worker_stats = stats
+    _worker_maxdepth = maxdepth
+
+
+def _regions_worker(lines):
+    return chunk_sums(lines, _worker_index, _worker_stats, _worker_maxdepth)
+
+
+def regions(args):
+    """
+    Condenses a read-depth file by calculating the average read depth pr. region
+    Every region gets all positions it contains, also when regions overlap. The depth file
+    must be sorted by position within each sequence, as written by 'samtools depth'.
+    The depth file is parsed in chunks into arrays, and the depths within each region are
+    summed with np.add.reduceat, see chunk_sums. With --threads, the chunks are parsed
+    and summed by a pool of processes.
+    With --stats, the standard deviation and quartiles of the depths in each region are
+    calculated in the same pass, and written in the same layout as the averages to
+    <prefix>.std.txt, <prefix>.Q1.txt, <prefix>.median.txt and <prefix>.Q3.txt.
+    With --cache, the averages are also written to the binary cache
+    <prefix>.regions.cache, see RegionCache.
+    The sums of depths and squared depths are kept as integers, so the variance is
+    exact. The quartiles come from a histogram of depths 0..--maxdepth for each sample,
+    where the last bin also holds all larger depths.
+    :param args:
+    :return:
+    """
+    index = read_bed_index(args.bedfile)
+    depthfile = args.infile[0]
+    if depthfile.endswith(".gz"):
+        depthfile = depthfile[:-3]
+    prefix = depthfile.rsplit(".", 1)[0]
+    outfiles = {"mean": "{}.regions.txt".format(prefix)}
+    if args.stats:
+        for stat in ("std", "Q1", "median", "Q3"):
+            outfiles[stat] = "{}.{}.txt".format(prefix, stat)
+
+    def write(name, last=None):
+        # Writes the regions ending before 'last', or all of them, ordered by stop
+        starts, stops = index[name][0], index[name][1]
+        done = [i for i in active if last is None or stops[i] < last]
+        for i in sorted(done, key=lambda i: (stops[i], starts[i])):
+            samples, entry, *moments = active.pop(i)
+            stats = {"mean": (samples / entry).tolist()}
+            if args.stats:
+                squares, hist = moments
+                stats["std"] = [
+                    ((entry * s2 - s * s) / entry ** 2) ** 0.5
+                    for s, s2 in zip(samples.tolist(), squares.tolist())
+                ]
+                # Histograms of the chunks the region was found in
+                keys = np.concatenate([k for k, c in hist])
+                counts = np.concatenate([c for k, c in hist])
+                order = np.argsort(keys, kind="stable")
+                q1, median, q3 = hist_quantiles(
+                    keys[order], counts[order], args.maxdepth + 1, (0.25, 0.5, 0.75)
+                )
+                stats["Q1"], stats["median"], stats["Q3"] = (
+                    q1.tolist(),
+                    median.tolist(),
+                    q3.tolist(),
+                )
+            if cache is not None:
+                cache.add(name, starts[i], stops[i], stats["mean"])
+            for stat, values in stats.items():
+                fouts[stat].write(
+                    "{}\t{}\t{}\t{}\n".format(
+                        name, starts[i], stops[i], "\t".join([str(v) for v in values])
+                    )
+                )
+
+    active = {}
+    rname = None
+    with contextlib.ExitStack() as stack:
+        fin = stack.enter_context(contextlib.closing(depth_lines(args.infile[0], index)))
+        # The cache is finished after the text files, so it is not older than them
+        cache = None
+        if args.cache:
+            cache = stack.enter_context(RegionCache(cache_dir(outfiles["mean"])))
+        fouts = {
+            stat: stack.enter_context(open(outfile, "w"))
+            for stat, outfile in outfiles.items()
+        }
+        chunks = line_chunks(fin, args.chunksize)
+        if args.threads > 1:
+            pool = stack.enter_context(
+                multiprocessing.Pool(
+                    args.threads,
+                    initializer=_init_regions_worker,
+                    initargs=(args.bedfile, args.stats, args.maxdepth),
                 )
             )
+            results = window(pool, _regions_worker, chunks, 2 * args.threads)
+        else:
+            results = (
+                chunk_sums(lines, index, args.stats, args.maxdepth) for lines in chunks
+            )
+        for runs in results:
+            for name, last, parts in runs:
+                if name != rname:
+                    if rname is not None:
+                        write(rname)
+                    rname = name
+                for i, n, *s in parts:
+                    if i in active:
+                        acc = active[i]
+                        acc[0] += s[0]
+                        acc[1] += n
+                        for k in range(1, len(s)):
+                            acc[k + 1] += s[k]
+                    else:
+                        active[i] = [s[0], n] + s[1:]
+                write(name, last)
+        if rname is not None:
+            write(rname)
+
+
+def window(pool, func, tasks, size):
+    """
+    Runs tasks in a pool of processes, with at most 'size' tasks read ahead, so memory
+    stays bounded
+    :return: Generator of results, in task order
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= size:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def read_regions(infile):
+    """
+    Reads a regions file, as written by regions()
+    :param infile: Regions file
+    :return: keys [(name, start, stop)], matrix of average depths (one row per region)
+    """
+    db = {}
+    with open(infile, "r") as fin:
+        for line in fin:
+            name, start, stop, *depth = line.strip().split()
+            db[(name, start, stop)] = depth
+    keys = list(db)
+    matrix = np.array(list(db.values()), dtype=np.float64).reshape(len(keys), -1)
+    return keys, matrix
+
+
+def standardize(matrix):
+    """
+    Centers each row and scales it to unit length, so the dot product of two rows is
+    their correlation. Rows without variance are set to 0, giving correlation 0.
+    :param matrix: Region x sample matrix
+    :return: Standardized matrix
+    """
+    centered = matrix - matrix.mean(axis=1, keepdims=True)
+    norm = np.sqrt((centered ** 2).sum(axis=1, keepdims=True))
+    return np.divide(centered, norm, out=np.zeros_like(centered), where=norm > 0)
+
+
+def write_standardized(infile, zfile, chunksize):
+    """
+    Stores the standardized matrix of a regions file on disk, as a .npy file that can
+    be memory-mapped. The regions file is read twice, chunksize lines at a time, so the
+    matrix is never held in memory.
+    :param infile: Regions file, as written by regions()
+    :param zfile: Output .npy file
+    :param chunksize: Number of lines standardized at a time
+    :return: keys [(name, start, stop)], in the same order as the rows of the matrix
+    """
+    # As in read_regions, the last line of a region is used, at its first position
+    lines = {}
+    with open(infile, "r") as fin:
+        for n, line in enumerate(fin):
+            name, start, stop, *depth = line.split()
+            lines[(name, start, stop)] = n
+    keys = list(lines)
+    rowof = {n: row for row, n in enumerate(lines.values())}
+    z = np.lib.format.open_memmap(
+        zfile, mode="w+", dtype=np.float64, shape=(len(keys), len(depth))
+    )
+    rows, chunk = [], []
+    with open(infile, "r") as fin:
+        for n, line in enumerate(fin):
+            if n not in rowof:
+                continue
+            rows.append(rowof[n])
+            chunk.append(line.split()[3:])
+            if len(chunk) >= chunksize:
+                z[rows] = standardize(np.array(chunk, dtype=np.float64))
+                rows, chunk = [], []
+    if chunk:
+        z[rows] = standardize(np.array(chunk, dtype=np.float64))
+    z.flush()
+    return keys
+
+
+def write_standardized_cache(matrix, zfile, chunksize):
+    """
+    Same as write_standardized, for a matrix from the binary cache
+    """
+    z = np.lib.format.open_memmap(zfile, mode="w+", dtype=np.float64, shape=matrix.shape)
+    for b in range(0, matrix.shape[0], chunksize):
+        chunk = np.asarray(matrix[b : b + chunksize], dtype=np.float64)
+        z[b : b + chunksize] = standardize(chunk)
+    z.flush()
+
+
+def select_top(corr, top):
+    """
+    Finds the largest values in each row of a matrix
+    :param corr: Matrix
+    :param top: Number of values to keep for each row, at most the number of columns
+    :return: columns, values; arrays of shape (rows, top), largest first, ties in column order
+    """
+    part = np.argpartition(corr, corr.shape[1] - top, axis=1)[:, -top:]
+    vals = np.take_along_axis(corr, part, axis=1)
+    # Rows with more columns tied at the cut-off than were kept: keep the first ones
+    kth = vals.min(axis=1, keepdims=True)
+    ties = np.flatnonzero((corr == kth).sum(axis=1) > (vals == kth).sum(axis=1))
+    if len(ties) > 0:
+        sub, cut = corr[ties], kth[ties]
+        above = sub > cut
+        tied = sub == cut
+        room = top - above.sum(axis=1, keepdims=True)
+        keep = above | (tied & (np.cumsum(tied, axis=1) <= room))
+        part[ties] = np.nonzero(keep)[1].reshape(len(ties), top)
+        vals[ties] = np.take_along_axis(sub, part[ties], axis=1)
+    order = np.lexsort((part, -vals))
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+def top_correlations(z, rows, top, colsize=None):
+    """
+    Finds the regions most correlated (absolute value) with a block of regions
+    The regions are compared colsize at a time, merging the best regions of each block
+    with the best so far, so memory use depends on the block sizes only.
+    :param z: Standardized matrix, see standardize, may be memory-mapped
+    :param rows: Array of row numbers in the block
+    :param top: Number of regions to keep for each row
+    :param colsize: Number of regions compared at a time, default all
+    :return: indices, correlations; arrays of shape (len(rows), top), best first
+    """
+    n = z.shape[0]
+    top = min(top, n - 1)
+    colsize = colsize or n
+    indices = np.zeros((len(rows), 0), dtype=np.int64)
+    values = np.zeros((len(rows), 0))
+    if top <= 0:
+        return indices, values
+    query = np.asarray(z[rows])
+    for c in range(0, n, colsize):
+        corr = np.abs(query @ np.asarray(z[c : c + colsize]).T)
+        # A region is not compared with itself
+        inside = np.flatnonzero((rows >= c) & (rows < c + colsize))
+        corr[inside, rows[inside] - c] = -1
+        idx, val = select_top(corr, min(top, corr.shape[1]))
+        if c == 0:
+            indices, values = idx, val
+            continue
+        indices = np.concatenate([indices, idx + c], axis=1)
+        values = np.concatenate([values, val], axis=1)
+        # Best first, ties in file order
+        order = np.lexsort((indices, -values))[:, :top]
+        indices = np.take_along_axis(indices, order, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+    return indices, values
+
+
+def _init_reference_worker(zfile, top, colsize):
+    global _worker_z, _worker_top, _worker_colsize
+    _worker_z = np.load(zfile, mmap_mode="r")
+    _worker_top = top
+    _worker_colsize = colsize
+
+
+def _reference_worker(rows):
+    return top_correlations(_worker_z, rows, _worker_top, _worker_colsize)
 
 
 def reference(args):
     """
     Compares each region with every other region and outputs the 100 most closely
     matched regions.
-    Criteria for what is "close" is very much WIP.
+    Criteria for what is "close" is very much WIP. Currently the absolute value of the
+    correlation, calculated in blocks of regions as products of the standardized matrix.
+    Without --chrom, every region in the file is used.
+    With --outofcore, the standardized matrix is stored as <prefix>.z.npy and
+    memory-mapped, and tiles of regions are compared in --threads processes.
+    The binary cache of the regions file is used when it is up to date. With --cache, the
+    neighbours are also written to a binary cache (x.dist.txt -> x.dist.cache): keys,
+    rows.npy (the regions compared), neighbours.npy (row numbers of their closest
+    regions) and values.npy (their correlations).
     :param args:
     :return:
     """
-    db = {}
-    outfile = "{}.{}.dist.txt".format(args.infile[0].rsplit(".", 1)[0], args.chrom)
-    with open(args.infile[0], "r") as fin, open(outfile, "w") as fout:
-        entry = 0
+    prefix = args.infile[0].rsplit(".", 1)[0]
+    if args.chrom:
+        outfile = "{}.{}.dist.txt".format(prefix, args.chrom)
+    else:
+        outfile = "{}.dist.txt".format(prefix)
+    cached = open_cache(args.infile[0], "matrix.npy")
+    if cached is not None:
+        keys = read_keys(cached)
+        matrix = np.load(os.path.join(cached, "matrix.npy"), mmap_mode="r")
+    if args.outofcore:
+        zfile = "{}.z.npy".format(prefix)
+        if cached is not None:
+            write_standardized_cache(matrix, zfile, args.chunksize)
+        else:
+            keys = write_standardized(args.infile[0], zfile, args.chunksize)
+        z = np.load(zfile, mmap_mode="r")
+    else:
+        if cached is None:
+            keys, matrix = read_regions(args.infile[0])
+        z = standardize(np.asarray(matrix, dtype=np.float64))
+    names = [key[0] for key in keys]
+    rows = np.array(
+        [i for i, name in enumerate(names) if not args.chrom or name == args.chrom],
+        dtype=np.int64,
+    )
+    tiles = [rows[b : b + args.blocksize] for b in range(0, len(rows), args.blocksize)]
+    pool = None
+    if args.outofcore and args.threads > 1:
+        pool = multiprocessing.Pool(
+            args.threads,
+            initializer=_init_reference_worker,
+            initargs=(zfile, args.top, args.colsize),
+        )
+        results = pool.imap(_reference_worker, tiles)
+    else:
+        colsize = args.colsize if args.outofcore else None
+        results = (top_correlations(z, tile, args.top, colsize) for tile in tiles)
+    if args.cache:
+        # Neighbours of each region in 'rows', as row numbers in the keys
+        directory = cache_dir(outfile)
+        os.makedirs(directory, exist_ok=True)
+        write_keys(directory, keys)
+        np.save(os.path.join(directory, "rows.npy"), rows)
+        top = max(0, min(args.top, len(keys) - 1))
+        neighbours = np.lib.format.open_memmap(
+            os.path.join(directory, "neighbours.npy"),
+            mode="w+",
+            dtype=np.int64,
+            shape=(len(rows), top),
+        )
+        correlations = np.lib.format.open_memmap(
+            os.path.join(directory, "values.npy"),
+            mode="w+",
+            dtype=np.float64,
+            shape=(len(rows), top),
+        )
+    try:
+        with open(outfile, "w") as fout:
+            b = 0
+            for tile, (indices, values) in zip(tiles, results):
+                if args.cache:
+                    neighbours[b : b + len(tile)] = indices
+                    correlations[b : b + len(tile)] = values
+                    b += len(tile)
+                for i, idx, val in zip(tile.tolist(), indices.tolist(), values.tolist()):
+                    k = "{}:{}-{}".format(*keys[i])
+                    a = "\t".join(
+                        ["{}:{}-{};{:.6f}".format(*keys[j], d) for j, d in zip(idx, val)]
+                    )
+                    fout.write("{}\t{}\n".format(k, a))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if args.cache:
+        neighbours.flush()
+        correlations.flush()
+        # Not older than the text file
+        os.utime(os.path.join(directory, "neighbours.npy"))
+
+
+def read_region_chunks(fin, chunksize):
+    """
+    Reads a regions file in chunks of lines
+    :param fin: Open regions file
+    :param chunksize: Number of lines in each chunk
+    :return: Generator of (keys [(name, start, stop)], matrix of average depths)
+    """
+    keys, chunk = [], []
+    for line in fin:
+        name, start, stop, *depth = line.strip().split()
+        keys.append((name, start, stop))
+        chunk.append(depth)
+        if len(chunk) >= chunksize:
+            yield keys, np.array(chunk, dtype=np.float64)
+            keys, chunk = [], []
+    if chunk:
+        yield keys, np.array(chunk, dtype=np.float64)
+
+
+def read_groups(groupsfile):
+    """
+    Reads sample groups, one group pr. line: name and 1-based sample columns, as ranges
+    separated by commas, eg. 'NTM1 25-39' or 'SCD 1-12,14-24'
+    Without a groups file, the only group is NTM1: 25-39
+    :param groupsfile: Name of groups file, or None
+    :return: {name: array of 0-based sample columns}
+    """
+    if groupsfile is None:
+        return {"NTM1": np.arange(24, 39)}
+    groups = {}
+    with open(groupsfile, "r") as fin:
         for line in fin:
-            name, start, stop, *depth = line.strip().split()
-            db[(name, start, stop)] = [float(d) for d in depth]
-        for key1, val1 in db.items():
-            dist = []
-            if key1[0] != args.chrom:
+            if line.strip() == "" or line.startswith("#"):
                 continue
-            for key2, val2 in db.items():
-                if key1 == key2:
-                    continue
-                # d = sum([(a - b)**2 for a,b in zip(val1, val2)])
-                d = np.corrcoef(val1, val2)[0, 1]
-                if np.isnan(d):
-                    d = 0
-                dist.append(key2 + (abs(d),))
-            val = sorted(dist, key=itemgetter(3), reverse=True)
-            k = "{}:{}-{}".format(key1[0], key1[1], key1[2])
-            a = "\t".join(
-                ["{}:{}-{};{:.6f}".format(b[0], b[1], b[2], b[3]) for b in val[0:100]]
-            )
-            fout.write("{}\t{}\n".format(k, a))
+            name, ranges = line.strip().split()
+            columns = []
+            for r in ranges.split(","):
+                first, _, last = r.partition("-")
+                columns.extend(range(int(first) - 1, int(last or first)))
+            groups[name] = np.array(columns)
+    return groups
+
+
+def stats_columns(a):
+    """
+    Statistics for each row of a matrix
+    :param a: Region x sample matrix
+    :return: mean, median, std, Q1, Q3, low outliers, high outliers; one list each
+    """
+    q1 = np.percentile(a, 25, axis=1)
+    q3 = np.percentile(a, 75, axis=1)
+    iqr = q3 - q1
+    o1 = (a < (q1 - 1.5 * iqr)[:, None]).sum(axis=1)
+    o3 = (a > (q3 + 1.5 * iqr)[:, None]).sum(axis=1)
+    columns = [a.mean(axis=1), np.median(a, axis=1), a.std(axis=1), q1, q3, o1, o3]
+    return [c.tolist() for c in columns]
 
 
 def regionstats(args):
     """
-    Calculates statistics for each region
+    Calculates statistics for each region, for each group of samples (--groups)
     Mean, std, boxplot-outliers
+    The regions are read in chunks, and the statistics calculated for all regions in a
+    chunk at once. Output for each group is written to <prefix>.<group>_stats.txt
+    The binary cache of the regions file is used when it is up to date.
     :param args:
     :return:
     """
-    outfile = "{}.NTM1_stats.txt".format(args.infile[0].rsplit(".", 1)[0])
-    with open(args.infile[0], "r") as fin, open(outfile, "w") as fout:
-        fout.write("chrom\tstart\tstop\tmean\tstd\tQ1\tmedian\tQ3\tO1\tO3\n")
-        entry = 0
-        next(fin)
-        for line in fin:
-            name, start, stop, *depth = line.strip().split()
-            # SCD: 1-24, NTM: 25-54, THA: 55-70, NTM1:25-39, NTM2:40-54
-            a = np.array([float(d) for d in depth[24:39]])
-            mn = np.mean(a)
-            md = np.median(a)
-            sd = np.std(a)
-            q1 = np.percentile(a, 25)
-            q3 = np.percentile(a, 75)
-            iqr = q3 - q1
-            o1 = sum(a < (q1 - 1.5 * iqr))
-            o3 = sum(a > (q3 + 1.5 * iqr))
-            fout.write(
-                "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                    name, start, stop, mn, md, sd, q1, q3, o1, o3
+    # SCD: 1-24, NTM: 25-54, THA: 55-70, NTM1:25-39, NTM2:40-54
+    groups = read_groups(args.groups)
+    prefix = args.infile[0].rsplit(".", 1)[0]
+    cached = open_cache(args.infile[0], "matrix.npy")
+    with contextlib.ExitStack() as stack:
+        fouts = {}
+        for group in groups:
+            fout = stack.enter_context(open("{}.{}_stats.txt".format(prefix, group), "w"))
+            fout.write("chrom\tstart\tstop\tmean\tstd\tQ1\tmedian\tQ3\tO1\tO3\n")
+            fouts[group] = fout
+        if cached is not None:
+            keys = read_keys(cached)
+            matrix = np.load(os.path.join(cached, "matrix.npy"), mmap_mode="r")
+            # The first region is skipped, as for the text file
+            chunks = (
+                (
+                    keys[b : b + args.chunksize],
+                    np.asarray(matrix[b : b + args.chunksize], dtype=np.float64),
                 )
+                for b in range(1, len(keys), args.chunksize)
             )
+        else:
+            fin = stack.enter_context(open(args.infile[0], "r"))
+            next(fin)
+            chunks = read_region_chunks(fin, args.chunksize)
+        for keys, matrix in chunks:
+            for group, columns in groups.items():
+                # Contiguous rows, so sums are done in the same order as for one region
+                stats = stats_columns(np.ascontiguousarray(matrix[:, columns]))
+                fouts[group].writelines(
+                    "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(*key, *values)
+                    for key, values in zip(keys, zip(*stats))
+                )
+
+
+def read_neighbours(directory):
+    """
+    Reads the neighbours cache written by reference()
+    :param directory: Cache directory
+    :return: keys [(name, start, stop)], rows (array of regions compared), neighbours
+             (memory-mapped matrix of row numbers, one row for each region compared)
+    """
+    keys = read_keys(directory)
+    rows = np.load(os.path.join(directory, "rows.npy"))
+    neighbours = np.load(os.path.join(directory, "neighbours.npy"), mmap_mode="r")
+    return keys, rows, neighbours
+
+
+def compare_cached(args, caches):
+    """
+    Same as compare, using the binary caches of both files. The neighbour sets of a
+    chunk of regions are compared at once: the sizes of the intersections are the
+    number of repeated values in each row of the sorted neighbours of both.
+    :param args:
+    :param caches: Cache directories of the two files
+    :return:
+    """
+    ids = {}
+    data = []
+    for directory in caches:
+        keys, rows, neighbours = read_neighbours(directory)
+        # Region numbers shared by both files
+        glob = np.array([ids.setdefault(key, len(ids)) for key in keys], dtype=np.int64)
+        data.append((keys, glob, rows, neighbours))
+    keys1, glob1, rows1, neighbours1 = data[0]
+    keys2, glob2, rows2, neighbours2 = data[1]
+    where = {g: i for i, g in enumerate(glob2[rows2].tolist())}
+    match = np.array([where.get(g, -1) for g in glob1[rows1].tolist()], dtype=np.int64)
+    outfile = "compare.txt"
+    with open(outfile, "w") as fout:
+        for b in range(0, len(rows1), args.chunksize):
+            rows = rows1[b : b + args.chunksize]
+            m = match[b : b + args.chunksize]
+            found = m >= 0
+            same = np.zeros(len(m), dtype=np.int64)
+            if found.any():
+                x = glob1[np.asarray(neighbours1[b : b + args.chunksize])[found]]
+                y = glob2[np.asarray(neighbours2[m[found]])]
+                both = np.sort(np.concatenate([x, y], axis=1), axis=1)
+                same[found] = (both[:, 1:] == both[:, :-1]).sum(axis=1)
+            for i, f, n in zip(rows.tolist(), found.tolist(), same.tolist()):
+                key = "{}:{}-{}".format(*keys1[i])
+                fout.write("{}\t{}\n".format(key, n if f else "missing"))
 
 
 def compare(args):
+    """
+    Compares the closest regions found by two runs of reference, and outputs the number
+    of regions in common for each region in the first file.
+    The binary caches are used when both files have an up-to-date cache.
+    :param args:
+    :return:
+    """
+    caches = [open_cache(distfile, "neighbours.npy") for distfile in args.infile[:2]]
+    if None not in caches:
+        compare_cached(args, caches)
+        return
     db = {}
     with open(args.infile[1], "r") as fin:
         for line in fin:
@@ -200,6 +1095,58 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--bedfile", help="Bedfile")
     parser.add_argument("-c", "--chrom", help="Limit analysis to this chromosome")
     parser.add_argument("-n", "--name", action="store", dest="name")
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=100000,
+        help="Number of depth lines parsed at a time",
+    )
+    parser.add_argument(
+        "--blocksize",
+        type=int,
+        default=1024,
+        help="Number of regions compared at a time in 'reference'",
+    )
+    parser.add_argument(
+        "--top", type=int, default=100, help="Number of closest regions to report"
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Also write a binary cache in 'regions' and 'reference'",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Also write std and quartiles of the depths in each region in 'regions'",
+    )
+    parser.add_argument(
+        "--maxdepth",
+        type=int,
+        default=1000,
+        help="Largest depth with its own histogram bin, for quartiles with --stats",
+    )
+    parser.add_argument(
+        "-g", "--groups", help="Sample groups for 'stats' (default: NTM1 25-39)"
+    )
+    parser.add_argument(
+        "--outofcore",
+        action="store_true",
+        help="Keep the region matrix on disk in 'reference' (memory-mapped .npy)",
+    )
+    parser.add_argument(
+        "--colsize",
+        type=int,
+        default=8192,
+        help="Number of regions each block is compared with at a time, with --outofcore",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes, in 'regions' and with --outofcore",
+    )
 
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(